@@ -0,0 +1,172 @@
+# DESCRIPTION: A local fake SSH server that stands in for the devices of a testbed, to try the broker
+# (and anything else that only needs SSH) without a simulation. Each device listens on its own port
+# of 127.0.0.1 and accepts any user name and password.
+# PLATFORM: Emulator for CISCO 8000
+#
+# Start it with:
+#     python -m lib.fake_ssh /tmp/fake_tb.yaml PE1 PE2
+# which writes a testbed file for the fake devices and serves them until Ctrl-C. Then, in a notebook:
+#     from lib.broker import attach_broker
+#     nodes = {'PE1': '', 'PE2': ''}
+#     broker = attach_broker("/tmp/fake_tb.yaml", nodes, backend='ssh')
+#     nodes['PE1'].configure("hostname PE1-NEW")
+#     nodes['PE1'].execute("show running-config")
+#
+# Commands on an exec channel (execute()):
+#     show running-config   -- the committed config lines
+#     show hostname         -- the hostname
+#     anything else         -- echoed back
+# An interactive shell (configure()) shows an IOS-XR prompt, enters config mode with 'configure',
+# and 'commit' applies the lines typed in config mode, including 'hostname <name>'.
+# With os linux the shell shows a Linux prompt and 'sudo config hostname <name>' renames the device.
+
+import argparse
+import socket
+import threading
+
+import paramiko
+import yaml
+
+
+class FakeDevice(object):
+
+    def __init__(self, name, os='iosxr'):
+        self.name = name
+        self.os = os
+        self.hostname = name
+        self.config = []
+        self.commands = []
+        self.lock = threading.Lock()
+
+    def prompt(self, config_mode=False):
+        if self.os == 'iosxr':
+            return 'RP/0/RP0/CPU0:%s%s#' % (self.hostname, '(config)' if config_mode else '')
+        return 'admin@%s:~$ ' % self.hostname
+
+    def execute(self, cmd):
+        with self.lock:
+            self.commands.append(cmd)
+            if cmd == 'show running-config':
+                return '\n'.join(self.config) + '\n'
+            if cmd in ('show hostname', 'hostname'):
+                return self.hostname + '\n'
+            if cmd.startswith('sudo config hostname '):
+                self.hostname = cmd.split()[-1]
+                return ''
+            return cmd + '\n'
+
+    def commit(self, lines):
+        with self.lock:
+            for line in lines:
+                if line.startswith('hostname '):
+                    self.hostname = line.split()[-1]
+            self.config += lines
+
+    # Serves the interactive shell of one channel, like the device CLI
+    def shell(self, chan):
+        candidate = None
+        chan.sendall(self.prompt().encode())
+        f = chan.makefile('rb')
+        for raw in f:
+            line = raw.decode(errors='replace').strip()
+            out = line + '\r\n'
+            if candidate is None:
+                if self.os == 'iosxr' and line in ('configure', 'configure terminal'):
+                    candidate = []
+                elif line in ('exit', 'logout'):
+                    break
+                elif line:
+                    out += self.execute(line).replace('\n', '\r\n')
+            elif line == 'commit':
+                self.commit(candidate)
+                candidate = []
+            elif line in ('end', 'exit'):
+                candidate = None
+            elif line:
+                candidate.append(line)
+            chan.sendall((out + self.prompt(candidate is not None)).encode())
+        chan.close()
+
+
+class _Server(paramiko.ServerInterface):
+
+    def __init__(self, device):
+        self.device = device
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, chan, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, chan):
+        threading.Thread(target=self.device.shell, args=(chan,), daemon=True).start()
+        return True
+
+    def check_channel_exec_request(self, chan, command):
+        def run():
+            chan.sendall(self.device.execute(command.decode(errors='replace')).encode())
+            chan.send_exit_status(0)
+            # The client closes the channel: closing it here may overtake the reply to the exec request
+            chan.shutdown_write()
+            while chan.recv(1024):
+                pass
+            chan.close()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+
+# The below function serves a fake device on a port of 127.0.0.1 (port 0: any free port)
+# from background threads, and returns the port.
+def serve_device(device, port=0, host_key=None):
+    host_key = host_key or paramiko.RSAKey.generate(2048)
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(16)
+
+    def accept():
+        while True:
+            conn, addr = sock.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(host_key)
+            transport.start_server(server=_Server(device))
+    threading.Thread(target=accept, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+# The below function serves fake devices with the given names and writes a testbed file for them.
+# Returns {name: FakeDevice}.
+def serve_testbed(yaml_file, names, os='iosxr'):
+    host_key = paramiko.RSAKey.generate(2048)
+    devices = {}
+    tb = {'devices': {}}
+    for name in names:
+        devices[name] = FakeDevice(name, os)
+        port = serve_device(devices[name], host_key=host_key)
+        tb['devices'][name] = {'alias': name, 'os': os, 'type': 'router' if os == 'iosxr' else 'linux',
+                               'connections': {'cli': {'ip': '127.0.0.1', 'port': port, 'protocol': 'ssh'}},
+                               'credentials': {'default': {'username': 'cisco', 'password': 'cisco123'}}}
+    with open(yaml_file, 'w') as f:
+        yaml.safe_dump(tb, f, default_flow_style=False)
+    return devices
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve fake SSH devices and write a testbed file for them")
+    parser.add_argument('yaml_file')
+    parser.add_argument('names', nargs='+')
+    parser.add_argument('--os', choices=['iosxr', 'linux'], default='iosxr')
+    args = parser.parse_args()
+    serve_testbed(args.yaml_file, args.names, args.os)
+    print("Serving", ', '.join(args.names), "- testbed in", args.yaml_file, flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
@@ -1,36 +1,62 @@
 from trex_stl_lib.api import *
+from pkt_cache import cached_pkt
+from size_mix import parse_size_mix, size_mix_vm
 
 class STLS1(object):
 
     def __init__ (self):
         self.mode  =0;
-        self.fsize  =64;
+        self.fsize  =64; # the size of the packet, or a mix of sizes (see size_mix.py)
+        self.latency_pps  =10; # the rate of the latency-tagged stream
+
+    # The fields of the base packet of each mode: (src, dst, tos, sport, dport)
+    pkt_fields = [
+        ("10.0.0.1", "10.1.1.1", 0xb8, 1025, 12),
+    ];
 
     def create_pkt_base (self):
-        t=[
-        Ether()/IP(src="10.0.0.1",dst="10.1.1.1",tos=0xb8)/UDP(dport=12,sport=1025),
-        ];
-        return t[self.mode]
+        # The UDP checksum is disabled (0) because the Field Engine trims the packets it covers
+        src, dst, tos, sport, dport = self.pkt_fields[self.mode]
+        return Ether()/IP(src=src,dst=dst,tos=tos)/UDP(dport=dport,sport=sport,chksum=0)
 
-    def create_stream (self):
-        # Create base packet and pad it to size
-        size = self.fsize - 4; # HW will add 4 bytes ethernet FCS
+    def cached_pkt_base (self, size):
+        # The base packet padded to size, built once for each of its fields by pkt_cache
+        return cached_pkt(('dscp_traffic1',) + self.pkt_fields[self.mode], size, self.create_pkt_base)
 
-        base_pkt = self.create_pkt_base ()
+    def create_stream (self):
+        # Create base packet and pad it to the largest size of the mix,
+        # the Field Engine cuts it to the sizes of the mix if there are several
+        size, vm = size_mix_vm(parse_size_mix(self.fsize)) # HW will add 4 bytes ethernet FCS
+        if vm:
+            vm.append(STLVmFixIpv4(offset='IP'))
 
-        pad = max(0, size - len(base_pkt)) * 'x'
+        base_pkt = self.cached_pkt_base(size)
 
-        pkt = STLPktBuilder(pkt = base_pkt/pad,
-                            vm = [])
+        pkt = STLPktBuilder(pkt_buffer = base_pkt,
+                            vm = vm)
 
         return STLStream(packet = pkt,
                          mode = STLTXCont())
 
 
 
-    def get_streams (self, direction = 0, **kwargs):
-        # create 1 stream 
-        return [ self.create_stream() ]
+    def create_latency_stream (self, pg_id):
+        # Same packets as create_stream() at the smallest size of the mix, tagged to measure their latency with pg_id
+        size = min(s for s, w in parse_size_mix(self.fsize)) - 4; # HW will add 4 bytes ethernet FCS
+        base_pkt = self.cached_pkt_base(size)
+
+        return STLStream(packet = STLPktBuilder(pkt_buffer = base_pkt),
+                         mode = STLTXCont(pps = self.latency_pps),
+                         flow_stats = STLFlowLatencyStats(pg_id = int(pg_id)))
+
+
+    def get_streams (self, direction = 0, pg_id = None, size = None, **kwargs):
+        # create 1 stream, and 1 latency-tagged stream if pg_id is given
+        if size is not None:
+            self.fsize = size
+        if pg_id is None:
+            return [ self.create_stream() ]
+        return [ self.create_stream(), self.create_latency_stream(pg_id) ]
 
 
 # dynamic load - used for trex console or emulator
@@ -0,0 +1,254 @@
+# DESCRIPTION: A local stand-in for the TREX STL Python API, to try stl_agent.py and its JSON protocol
+# without a TREX server. FakeSTLClient has the methods of STLClient that the agent calls. It counts the
+# packets of the running traffic at the rate given by mult, as if every packet came back on the port.
+# PLATFORM: Emulator for CISCO 8000
+#
+# Run the agent on the fake API, reading one JSON request per line on stdin like stl_agent.py:
+#     python fake_stl.py
+#     {"id": 1, "cmd": "connect"}
+# Run connect, acquire, start, stats, pgid_stats, stop and disconnect through the agent and check the replies:
+#     python fake_stl.py --check
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import types
+
+FAKE_PORTS = [0, 1]
+FAKE_PKT_SIZE = 64
+
+
+class STLError(Exception):
+    pass
+
+
+# Packets per second of a mult such as '100pps' or '1kpps'. Other mults (e.g. '50%') send 100pps.
+def _pps(mult):
+    m = re.match(r'([0-9.]+)([km]?)pps$', str(mult).lower())
+    if not m:
+        return 100.0
+    return float(m.group(1)) * {'': 1, 'k': 1e3, 'm': 1e6}[m.group(2)]
+
+
+class FakeSTLProfile(object):
+
+    def __init__(self, profile, tunables):
+        self.profile = profile
+        self.tunables = tunables
+
+    @staticmethod
+    def load(profile, direction=0, port_id=0, **tunables):
+        if not os.path.exists(profile):
+            raise STLError("Profile %s does not exist" % profile)
+        return FakeSTLProfile(profile, tunables)
+
+    def get_streams(self):
+        return [self]
+
+
+class FakeSTLClient(object):
+
+    def __init__(self, server='127.0.0.1', sync_port=4501, async_port=4500):
+        self.server = server
+        self.sync_port = sync_port
+        self.connected = False
+        self.owned = set()
+        self.streams = {}
+        self.rates = {}
+        self.ends = {}
+        self.last = {}
+        self.sent = dict((p, 0.0) for p in FAKE_PORTS)
+        self.lock = threading.Lock()
+
+    def _ports(self, ports, owned=True):
+        if not self.connected:
+            raise STLError("Not connected to %s:%d" % (self.server, self.sync_port))
+        ports = FAKE_PORTS if ports is None else ports
+        if owned and not set(ports) <= self.owned:
+            raise STLError("Ports %s are not acquired" % sorted(set(ports) - self.owned))
+        return ports
+
+    # Adds the packets sent since the last call to the counters, and ends the runs with a duration
+    def _settle(self):
+        now = time.time()
+        for p, rate in list(self.rates.items()):
+            until = min(now, self.ends[p] or now)
+            self.sent[p] += rate * max(0.0, until - self.last[p])
+            self.last[p] = until
+            if self.ends[p] is not None and now >= self.ends[p]:
+                del self.rates[p]
+
+    def connect(self):
+        self.connected = True
+
+    def get_server_version(self):
+        self._ports(None, owned=False)
+        return {'version': 'fake', 'mode': 'STL'}
+
+    def acquire(self, ports, force=False):
+        self.owned.update(self._ports(ports, owned=False))
+
+    def release(self, ports):
+        self.stop(ports)
+        self.owned.difference_update(ports)
+
+    def reset(self, ports):
+        self.stop(ports)
+        for p in ports:
+            self.streams.pop(p, None)
+
+    def add_streams(self, streams, ports):
+        for p in self._ports(ports):
+            self.streams.setdefault(p, []).extend(streams)
+
+    def start(self, ports, mult='1', duration=-1, force=False):
+        with self.lock:
+            self._settle()
+            for p in self._ports(ports):
+                if not self.streams.get(p):
+                    raise STLError("Port %d has no streams" % p)
+                if p in self.rates and not force:
+                    raise STLError("Port %d is active" % p)
+            for p in ports:
+                self.rates[p] = _pps(mult)
+                self.last[p] = time.time()
+                self.ends[p] = self.last[p] + duration if duration > 0 else None
+
+    def stop(self, ports=None):
+        with self.lock:
+            self._settle()
+            for p in self._ports(ports, owned=ports is not None):
+                self.rates.pop(p, None)
+
+    def update(self, ports=None, mult='1'):
+        with self.lock:
+            self._settle()
+            for p in self._ports(ports, owned=ports is not None):
+                if p in self.rates:
+                    self.rates[p] = _pps(mult)
+
+    def get_stats(self, ports=None):
+        with self.lock:
+            self._settle()
+            stats = {}
+            for p in self._ports(ports, owned=False):
+                rate = self.rates.get(p, 0.0)
+                stats[p] = {'opackets': int(self.sent[p]), 'ipackets': int(self.sent[p]),
+                            'obytes': int(self.sent[p]) * FAKE_PKT_SIZE, 'ibytes': int(self.sent[p]) * FAKE_PKT_SIZE,
+                            'tx_pps': rate, 'rx_pps': rate, 'tx_bps': rate * FAKE_PKT_SIZE * 8, 'rx_bps': rate * FAKE_PKT_SIZE * 8}
+            port_stats = [stats[p] for p in stats]
+            stats['total'] = dict((k, sum(s[k] for s in port_stats)) for k in ('opackets', 'ipackets', 'obytes', 'ibytes',
+                                                                               'tx_pps', 'rx_pps', 'tx_bps', 'rx_bps'))
+            stats['global'] = {'tx_pps': stats['total']['tx_pps'], 'rx_pps': stats['total']['rx_pps'],
+                               'tx_bps': stats['total']['tx_bps'], 'rx_bps': stats['total']['rx_bps'],
+                               'rx_drop_bps': 0.0, 'cpu_util': 1.0}
+            return stats
+
+    # Each pg_id counts all the packets sent, with a fixed latency
+    def get_pgid_stats(self, pg_ids=None):
+        total = self.get_stats()['total']['opackets']
+        pg_ids = pg_ids or []
+        return {'flow_stats': dict((pg, {'tx_pkts': {'total': total}, 'rx_pkts': {'total': total}}) for pg in pg_ids),
+                'latency': dict((pg, {'latency': {'average': 10.0, 'total_max': 20, 'total_min': 5}}) for pg in pg_ids)}
+
+    def clear_stats(self, ports=None):
+        with self.lock:
+            self._settle()
+            for p in self._ports(ports, owned=False):
+                self.sent[p] = 0.0
+
+    def is_traffic_active(self, ports=None):
+        with self.lock:
+            self._settle()
+            return any(p in self.rates for p in self._ports(ports, owned=False))
+
+    def disconnect(self):
+        if self.connected:
+            self.release(sorted(self.owned))
+        self.connected = False
+
+
+# The below function makes 'from trex_stl_lib.api import ...' return the fake API, so that
+# stl_agent.py can be imported without TREX.
+def install():
+    api = types.ModuleType('trex_stl_lib.api')
+    api.STLClient = FakeSTLClient
+    api.STLProfile = FakeSTLProfile
+    api.STLError = STLError
+    package = types.ModuleType('trex_stl_lib')
+    package.api = api
+    sys.modules['trex_stl_lib'] = package
+    sys.modules['trex_stl_lib.api'] = api
+
+
+# The below function runs the agent on the fake API in a child process and checks its replies to
+# connect, acquire, start, stats, pgid_stats, stop and disconnect. Returns the replies by command.
+def check(python=sys.executable):
+    agent = subprocess.Popen([python, '-u', os.path.abspath(__file__)], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    next_id = [0]
+
+    def call(cmd, **args):
+        next_id[0] += 1
+        agent.stdin.write((json.dumps({'id': next_id[0], 'cmd': cmd, 'args': args}) + '\n').encode())
+        agent.stdin.flush()
+        reply = json.loads(agent.stdout.readline().decode())
+        if reply.get('id') != next_id[0]:
+            raise AssertionError("Reply %r to request %d" % (reply, next_id[0]))
+        return reply
+
+    replies = {}
+    try:
+        replies['connect'] = call('connect')
+        replies['acquire'] = call('acquire', ports=[0, 1])
+        replies['start'] = call('start', profile='traffic_3st.py', ports=[0], mult='1kpps', duration=-1, tunables={})
+        time.sleep(0.2)
+        replies['stats'] = call('stats')
+        replies['pgid_stats'] = call('pgid_stats', pg_ids=[7])
+        replies['bad_start'] = call('start', profile='traffic_3st.py', ports=[3], tunables={})
+        replies['stop'] = call('stop', ports=[0])
+        replies['is_traffic_active'] = call('is_traffic_active')
+        replies['disconnect'] = call('disconnect')
+        agent.stdin.close()
+        # The agent returns after disconnect
+        if agent.wait(timeout=10) != 0:
+            raise AssertionError("The agent exited with %d" % agent.returncode)
+    finally:
+        if agent.poll() is None:
+            agent.kill()
+    for cmd in ('connect', 'acquire', 'start', 'stats', 'pgid_stats', 'stop', 'is_traffic_active', 'disconnect'):
+        if 'error' in replies[cmd]:
+            raise AssertionError("%s failed: %s" % (cmd, replies[cmd]['error']))
+    if not replies['stats']['result']['0']['opackets'] > 0:
+        raise AssertionError("No packets counted on port 0: %r" % replies['stats'])
+    if not replies['pgid_stats']['result']['flow_stats']['7']['rx_pkts']['total'] > 0:
+        raise AssertionError("No packets counted for pg_id 7: %r" % replies['pgid_stats'])
+    if 'error' not in replies['bad_start']:
+        raise AssertionError("Starting a port that was not acquired did not fail")
+    if replies['is_traffic_active']['result']:
+        raise AssertionError("Traffic still active after stop")
+    return replies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run stl_agent.py on a fake TREX STL API")
+    parser.add_argument('--check', action='store_true', help="check the agent protocol against the fake API and exit")
+    args = parser.parse_args()
+    if args.check:
+        for cmd, reply in check().items():
+            print(cmd, json.dumps(reply))
+        print("OK")
+        sys.exit(0)
+    install()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import stl_agent
+    # The replies go to stdout, like in stl_agent.py
+    replies = sys.stdout
+    sys.stdout = sys.stderr
+    stl_agent.Agent('127.0.0.1', 4501, 4500).serve(sys.stdin, replies)
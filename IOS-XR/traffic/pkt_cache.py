@@ -0,0 +1,33 @@
+from trex_stl_lib.api import *
+from collections import OrderedDict
+
+# Cache of the base packets of the profiles, copied next to them in the stl/ directory of the TREX server.
+# TREX reloads a profile and calls get_streams() for every port and direction it is loaded on,
+# but this module is only imported once, so a packet is built by Scapy and serialized only the
+# first time a (template, size) key is seen. The least recently used packets are dropped after
+# PKT_CACHE_SIZE entries.
+PKT_CACHE_SIZE = 128
+
+_cache = OrderedDict()
+
+def cached_pkt(template, size, build):
+    """Return the bytes of the packet build() padded to size bytes, for STLPktBuilder(pkt_buffer=...).
+
+    Keyword arguments:
+    template -- a hashable key with every field of the packet that build() returns, since the
+                cache is kept when the profile is reloaded with other fields
+    size -- the packet size without the 4 bytes of the ethernet FCS
+    build -- a function that returns the Scapy packet
+    """
+    key = (template, size)
+    pkt = _cache.get(key)
+    if pkt is None:
+        base_pkt = build()
+        pad = max(0, size - len(base_pkt)) * 'x'
+        pkt = bytes(base_pkt/pad)
+        _cache[key] = pkt
+        if len(_cache) > PKT_CACHE_SIZE:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(key)
+    return pkt
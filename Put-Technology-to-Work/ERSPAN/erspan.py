@@ -25,6 +25,7 @@ print(sys.version)
 logging.basicConfig(level=logging.INFO)
 sys.path.append("../../")
 from image_version import *
+from console_utils import *
 sys.path.append("..")
 from trafficUtils.TrafficGenerator import generate_3traffic_streams
 
@@ -18,6 +18,7 @@ print(sys.version)
 logging.basicConfig(level=logging.INFO)
 sys.path.append("../../")
 from image_version import *
+from console_utils import *
 
 # Setting up scratch space for the simulation
 sim_dir = '/nobackup/' + getpass.getuser() + '/pyvxr/' + ''.join(random.choices(string.ascii_lowercase + string.digits, k=10))
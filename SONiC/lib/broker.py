@@ -0,0 +1,331 @@
+# DESCRIPTION: A small local broker process that keeps the device sessions of a testbed open
+# across notebook runs and kernel restarts. Notebooks attach to it over a local socket.
+# PLATFORM: Emulator for CISCO 8000
+#
+# Start it from a notebook with:
+#     from lib.broker import attach_broker
+#     broker = attach_broker("lib/leaf_spine.yaml", nodes)
+# and then use nodes['S0'].execute(...) / nodes['S0'].configure(...) as usual.
+#
+# Or run it by hand with:
+#     python -m lib.broker lib/leaf_spine.yaml --backend ssh
+
+import argparse
+import hashlib
+import os
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+BROKER_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'network-notebooks', 'broker')
+
+def _broker_paths(yaml_file):
+    key = hashlib.sha256(os.path.abspath(yaml_file).encode()).hexdigest()[:16]
+    base = os.path.join(BROKER_DIR, key)
+    return base + '.sock', base + '.key', base + '.log'
+
+
+# pyATS backend: the sessions are the connected pyATS devices of the testbed.
+class PyatsSessions(object):
+
+    def __init__(self, yaml_file):
+        from pyats.topology import loader
+        self.tb = loader.load(yaml_file)
+
+    def devices(self):
+        return [d.alias or d.name for d in self.tb.devices.values()]
+
+    def open(self, name):
+        device = self.tb.devices[name]
+        device.connect(learn_os=True, learn_hostname=True, prompt_recovery=True)
+        return device
+
+    def is_alive(self, device):
+        return device.is_connected()
+
+    def execute(self, device, cmd, **kwargs):
+        return device.execute(cmd, **kwargs)
+
+    def configure(self, device, cfg, **kwargs):
+        return device.configure(cfg, **kwargs)
+
+    def close(self, device):
+        device.disconnect()
+
+
+# A shell is ready for the next line when its output ends with a prompt, e.g. RP/0/RP0/CPU0:PE1#,
+# RP/0/RP0/CPU0:PE1(config)# or admin@sonic:~$
+SHELL_PROMPT = re.compile(rb'[#>$] ?$')
+
+# SSH backend: one long-lived paramiko transport per device, with an exec channel per command.
+# configure() types the lines into an interactive shell: in config mode followed by a commit on
+# IOS-XR, one command at a time on the other devices (e.g. 'sudo config ...' on SONiC).
+# It only needs paramiko and the testbed file, so it also works against the local fake SSH
+# server of lib/fake_ssh.py.
+class SSHSessions(object):
+
+    def __init__(self, yaml_file):
+        import yaml
+        with open(yaml_file) as f:
+            tb = yaml.safe_load(f)
+        self.specs = {}
+        self.os = {}
+        for name, dev in tb['devices'].items():
+            cli = dev['connections']['cli']
+            creds = dev.get('credentials', {}).get('default', {})
+            self.specs[dev.get('alias', name)] = (cli['ip'], int(cli['port']), creds.get('username'), creds.get('password'))
+            self.os[dev.get('alias', name)] = dev.get('os')
+
+    def devices(self):
+        return list(self.specs)
+
+    def open(self, name):
+        import paramiko
+        ip, port, username, password = self.specs[name]
+        client = paramiko.SSHClient()
+        # Set SSH key parameters to auto accept unknown hosts
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname=ip, port=port, username=username, password=password, allow_agent=False, look_for_keys=False)
+        client.get_transport().set_keepalive(30)
+        client.device_os = self.os[name]
+        return client
+
+    def is_alive(self, client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def execute(self, client, cmd, timeout=120):
+        stdin, stdout, stderr = client.exec_command(cmd, timeout=timeout)
+        return (stdout.read() + stderr.read()).decode(errors='replace')
+
+    def _read_prompt(self, shell):
+        out = b''
+        while not SHELL_PROMPT.search(out[-256:]):
+            data = shell.recv(65536)
+            if not data:
+                raise EOFError("The shell was closed")
+            out += data
+        return out
+
+    def configure(self, client, cfg, timeout=120):
+        lines = cfg.splitlines() if isinstance(cfg, str) else list(cfg)
+        lines = [line.strip() for line in lines if line.strip()]
+        if client.device_os == 'iosxr':
+            lines = ['configure terminal'] + lines + ['commit', 'end']
+        shell = client.invoke_shell(width=511)
+        shell.settimeout(timeout)
+        out = b''
+        try:
+            out += self._read_prompt(shell)
+            for line in lines:
+                shell.send(line + '\n')
+                out += self._read_prompt(shell)
+        except socket.timeout:
+            raise TimeoutError("No prompt after %d seconds, output so far: %r" % (timeout, out[-256:]))
+        finally:
+            shell.close()
+        return out.decode(errors='replace')
+
+    def close(self, client):
+        client.close()
+
+
+BACKENDS = {'pyats': PyatsSessions, 'ssh': SSHSessions}
+
+
+class Broker(object):
+
+    def __init__(self, yaml_file, backend='pyats'):
+        self.yaml_file = yaml_file
+        self.backend = BACKENDS[backend](yaml_file)
+        self.sessions = {}
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.listener = None
+        self.closed = False
+
+    def _lock(self, name):
+        with self.locks_lock:
+            return self.locks.setdefault(name, threading.Lock())
+
+    def _session(self, name):
+        session = self.sessions.get(name)
+        if session is None or not self.backend.is_alive(session):
+            if session is not None:
+                try:
+                    self.backend.close(session)
+                except Exception:
+                    pass
+            session = self.sessions[name] = self.backend.open(name)
+        return session
+
+    def handle(self, request):
+        op = request[0]
+        if op == 'ping':
+            return os.getpid()
+        if op == 'devices':
+            return self.backend.devices()
+        if op == 'connect':
+            name = request[1]
+            with self._lock(name):
+                self._session(name)
+            return True
+        if op in ('execute', 'configure'):
+            op, name, cmd, kwargs = request
+            with self._lock(name):
+                session = self._session(name)
+                return getattr(self.backend, op)(session, cmd, **kwargs)
+        if op == 'shutdown':
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return True
+        raise ValueError("Unknown broker request: %r" % (op,))
+
+    def _serve_client(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ('ok', self.handle(request))
+                except Exception as e:
+                    reply = ('error', '%s: %s' % (type(e).__name__, e))
+                conn.send(reply)
+
+    def serve_forever(self):
+        sock_path, key_path, log_path = _broker_paths(self.yaml_file)
+        os.makedirs(BROKER_DIR, exist_ok=True)
+        authkey = secrets.token_bytes(32)
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(authkey)
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+        self.sock_path = sock_path
+        self.listener = Listener(sock_path, family='AF_UNIX', authkey=authkey)
+        print("Broker for", self.yaml_file, "listening on", sock_path, flush=True)
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self.closed:
+                    # The listener was closed by shutdown()
+                    return
+                # Failed authentication or a client that went away during it, keep serving
+                continue
+            threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+    def shutdown(self):
+        for name, session in list(self.sessions.items()):
+            try:
+                self.backend.close(session)
+            except Exception:
+                pass
+        self.sessions.clear()
+        self.closed = True
+        if self.listener is not None:
+            # Closing the listener does not wake up a blocked accept(), a connection that fails the handshake does
+            try:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(self.sock_path)
+            except OSError:
+                pass
+            self.listener.close()
+
+
+class BrokerError(Exception):
+    pass
+
+# Client side of the broker. Requests from several threads are sent one at a time.
+class BrokerClient(object):
+
+    def __init__(self, yaml_file):
+        sock_path, key_path, log_path = _broker_paths(yaml_file)
+        with open(key_path, 'rb') as f:
+            authkey = f.read()
+        self.conn = Client(sock_path, family='AF_UNIX', authkey=authkey)
+        self.lock = threading.Lock()
+
+    def request(self, *request):
+        with self.lock:
+            self.conn.send(request)
+            status, result = self.conn.recv()
+        if status == 'error':
+            raise BrokerError(result)
+        return result
+
+    def shutdown(self):
+        self.request('shutdown')
+        self.conn.close()
+
+    def close(self):
+        self.conn.close()
+
+# Stand-in for a pyATS device whose session is owned by the broker.
+class BrokerDevice(object):
+
+    def __init__(self, client, name, display=True):
+        self.client = client
+        self.name = name
+        self.display = display
+
+    def execute(self, cmd, **kwargs):
+        out = self.client.request('execute', self.name, cmd, kwargs)
+        if self.display:
+            print(out)
+        return out
+
+    def configure(self, cfg, **kwargs):
+        out = self.client.request('configure', self.name, cfg, kwargs)
+        if self.display:
+            print(out)
+        return out
+
+
+def _connect_broker(yaml_file):
+    try:
+        client = BrokerClient(yaml_file)
+        client.request('ping')
+        return client
+    except (OSError, EOFError, AuthenticationError):
+        return None
+
+# The below function attaches to the broker of a testbed, starting it first if it is not running,
+# and fills the nodes dict with devices whose sessions stay open in the broker.
+def attach_broker(yaml_file, nodes, backend='pyats', timeout=60):
+    client = _connect_broker(yaml_file)
+    if client is None:
+        sock_path, key_path, log_path = _broker_paths(yaml_file)
+        os.makedirs(BROKER_DIR, exist_ok=True)
+        with open(log_path, 'ab') as log:
+            subprocess.Popen([sys.executable, '-m', 'lib.broker', os.path.abspath(yaml_file), '--backend', backend],
+                             stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                             start_new_session=True)
+        deadline = time.time() + timeout
+        while client is None:
+            if time.time() > deadline:
+                raise BrokerError("The broker did not start, see " + log_path)
+            time.sleep(0.2)
+            client = _connect_broker(yaml_file)
+
+    print("\n*** Attaching to the device sessions in the broker ***")
+    for n in nodes:
+        client.request('connect', n)
+        nodes[n] = BrokerDevice(client, n)
+    return client
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Keep the device sessions of a testbed open for the notebooks")
+    parser.add_argument('yaml_file')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='pyats')
+    args = parser.parse_args()
+    Broker(args.yaml_file, args.backend).serve_forever()
@@ -12,7 +12,18 @@ import shutil
 import getpass
 import string
 import random
+import re
+import json
+import glob
+import hashlib
+import pickle
+import shlex
+import socket
+import zlib
+import tempfile
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 print(sys.version)
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
@@ -21,41 +32,658 @@ from lib.image_version import *
 from pyats.topology import loader
 from paramiko_expect import SSHClientInteraction
 import paramiko
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 from traffic.TrafficGenerator import generate_bidir_traffic
     
-def access_device_consoles(yaml_file, nodes):
+# Per-device results of the last access_device_consoles() call.
+# Maps the node name to {'latency': seconds, 'error': exception or None, 'cached_facts': True/False}.
+connect_report = {}
+
+# The OS, hostname and prompt learned at login are cached per testbed file and device,
+# so that later logins can skip the learn_os/learn_hostname discovery. A login with cached facts
+# checks the prompt the device shows, and learns the facts again if it changed, e.g. after a
+# reimage or a hostname change.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'network-notebooks')
+DEVICE_FACTS_FILE = os.path.join(CACHE_DIR, 'device_facts.json')
+
+def _load_device_facts():
+    try:
+        with open(DEVICE_FACTS_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_device_facts(facts):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_file = DEVICE_FACTS_FILE + '.' + str(os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(facts, f, indent=1)
+    os.replace(tmp_file, DEVICE_FACTS_FILE)
+
+# The below function drops the cached facts of the given devices (default: all devices in the testbed).
+# Call it after a device is reimaged or its hostname is changed, e.g. with 'sudo config hostname'.
+def clear_device_facts(yaml_file, devices=None):
+    facts = _load_device_facts()
+    tb_facts = facts.get(os.path.abspath(yaml_file), {})
+    for n in (list(tb_facts) if devices is None else devices):
+        tb_facts.pop(n, None)
+    _save_device_facts(facts)
+
+# The prompt the device shows at the moment, e.g. RP/0/RP0/CPU0:PE1# or admin@SPINE0:~$
+def _current_prompt(console):
+    spawn = console.default.spawn
+    spawn.sendline()
+    match = spawn.expect(r'[^\r\n]*[#>$] ?$', timeout=10)
+    return match.match_output.strip().splitlines()[-1].strip()
+
+def _learned_facts(console, prompt=None):
+    conn = getattr(console, 'default', None)
+    hostname = getattr(conn, 'hostname', None) or getattr(console, 'learned_hostname', None)
+    if not hostname or not console.os:
+        return None
+    if prompt is None:
+        try:
+            prompt = _current_prompt(console)
+        except Exception:
+            pass
+    return {'os': console.os, 'hostname': hostname, 'prompt': prompt}
+
+# True if the prompt the device shows still matches its cached facts
+def _facts_match(cached, prompt):
+    if cached.get('prompt'):
+        return prompt == cached['prompt']
+    return cached['hostname'] in prompt
+
+# The below function checks that the cli connection of a device accepts TCP connections, to tell an
+# unreachable device from one whose cached facts are stale when a connect fails.
+def _reachable(console, timeout=5):
+    try:
+        cli = console.connections.cli
+        address = (str(cli.ip), int(getattr(cli, 'port', None) or 22))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        # No address to check, the connect that learns the facts will tell
+        return True
+    try:
+        socket.create_connection(address, timeout=timeout).close()
+    except OSError:
+        return False
+    return True
+
+def _disconnect_quietly(console):
+    try:
+        console.disconnect()
+    except Exception:
+        pass
+
+# Returns (node, device, seconds, error, True if the cached facts were used, prompt or None)
+# The facts are learned again only when the cached ones are wrong: the device shows another prompt, or
+# the connect fails while the device is reachable (a stale hostname does not match the prompt).
+# An unreachable device is not connected a second time, which would wait for the timeout again.
+def _connect_device(tb, n, cached=None):
+    start = time.time()
+    console = tb.devices[n]
+    if cached is not None:
+        try:
+            console.os = cached['os']
+            console.connect(learn_os=False, learn_hostname=False, hostname=cached['hostname'], prompt_recovery=True)
+        except Exception as e:
+            _disconnect_quietly(console)
+            if isinstance(e, OSError) or not _reachable(console):
+                return n, console, time.time() - start, e, True, None
+        else:
+            try:
+                prompt = _current_prompt(console)
+            except Exception as e:
+                _disconnect_quietly(console)
+                return n, console, time.time() - start, e, True, None
+            if _facts_match(cached, prompt):
+                return n, console, time.time() - start, None, True, prompt
+            # The device changed since the facts were cached, learn them again
+            print("%s shows the prompt %r, not the cached %r, learning its facts again" %
+                  (n, prompt, cached.get('prompt') or cached['hostname']))
+            _disconnect_quietly(console)
+    try:
+        console.connect(learn_os=True, learn_hostname=True, prompt_recovery=True)
+    except Exception as e:
+        return n, console, time.time() - start, e, False, None
+    return n, console, time.time() - start, None, False, None
+
+# Loaded testbed objects are pickled here, keyed by the testbed file path, mtime and content hash,
+# so that repeated notebook runs and kernel restarts skip the YAML parsing and schema validation.
+TESTBED_CACHE_DIR = os.path.join(CACHE_DIR, 'testbeds')
+
+# The below function loads a testbed file, using the compiled testbed cache when it is up to date.
+def load_testbed(yaml_file):
+    path = os.path.abspath(yaml_file)
+    with open(path, 'rb') as f:
+        content = f.read()
+    path_key = hashlib.sha256(path.encode()).hexdigest()[:16]
+    content_key = hashlib.sha256(str(os.stat(path).st_mtime_ns).encode() + b':' + content).hexdigest()[:32]
+    cache_file = os.path.join(TESTBED_CACHE_DIR, path_key + '-' + content_key + '.pickle')
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        pass
+
+    tb = loader.load(path)
+    try:
+        data = pickle.dumps(tb, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        # This testbed cannot be pickled, it is loaded from the YAML file every time
+        return tb
+    os.makedirs(TESTBED_CACHE_DIR, exist_ok=True)
+    for old_file in glob.glob(os.path.join(TESTBED_CACHE_DIR, path_key + '-*.pickle')):
+        os.remove(old_file)
+    tmp_file = cache_file + '.' + str(os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file, cache_file)
+    return tb
+
+# The below function logs into all the devices in the nodes dict.
+# Set max_workers to log into up to that many devices at the same time.
+# Set use_cached_facts=False to always learn the OS and hostname of the devices.
+# Every device is tried, and then the error of the first device that failed to log in is raised.
+def access_device_consoles(yaml_file, nodes, max_workers=1, use_cached_facts=True):
     import yaml
     
-    tb = loader.load(yaml_file)
+    tb = load_testbed(yaml_file)
+    facts = _load_device_facts()
+    tb_facts = facts.setdefault(os.path.abspath(yaml_file), {})
+    if not use_cached_facts:
+        tb_facts.clear()
+
     print("\n*** Logging into the devices ***")
-    for n in nodes:
-       console = tb.devices[n]
-       out = console.connect(learn_os=True, learn_hostname=True, prompt_recovery=True)
-       nodes[n] = console
+    connect_report.clear()
+    if max_workers > 1 and len(nodes) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(nodes))) as pool:
+            results = list(pool.map(lambda n: _connect_device(tb, n, tb_facts.get(n)), nodes))
+    else:
+        results = [_connect_device(tb, n, tb_facts.get(n)) for n in nodes]
+
+    for n, console, latency, error, used_cache, prompt in results:
+        connect_report[n] = {'latency': latency, 'error': error, 'cached_facts': used_cache}
+        if error is None:
+            nodes[n] = console
+            learned = _learned_facts(console, prompt)
+            if learned is not None:
+                tb_facts[n] = learned
+            print("%-10s connected in %.1f sec" % (n, latency))
+        else:
+            # The cached facts are only dropped when learning them again failed too
+            if not used_cache:
+                tb_facts.pop(n, None)
+            print("%-10s FAILED after %.1f sec: %s" % (n, latency, error))
+    _save_device_facts(facts)
+
+    # The devices that failed are not in nodes, so stop here with the error of the first one
+    failed = [n for n in connect_report if connect_report[n]['error'] is not None]
+    if failed:
+        raise connect_report[failed[0]]['error']
     return tb
 
+# The below function changes the hostname of a SONiC node, saves the config
+# and drops the cached facts of the node so the next login learns the new prompt.
+def config_hostname(yaml_file, nodes, n, hostname):
+    out = nodes[n].execute('sudo config hostname ' + hostname)
+    out = nodes[n].execute('sudo config save -y')
+    clear_device_facts(yaml_file, [n])
+    return out
 
-def copy_file_to_rtr(rtr_ip, rtr_port, src_file, dst_on_rtr):
+
+def _execute_on_device(device, commands):
+    result = {'outputs': {}, 'timings': {}, 'latency': 0.0, 'error': None}
+    start = time.time()
+    for cmd in commands:
+        cmd_start = time.time()
+        try:
+            result['outputs'][cmd] = device.execute(cmd)
+        except Exception as e:
+            result['error'] = e
+            break
+        finally:
+            result['timings'][cmd] = time.time() - cmd_start
+    result['latency'] = time.time() - start
+    return result
+
+# The below function runs the same commands on several devices at the same time.
+# commands can be a single command or a list of commands, run in order on each device.
+# devices is a list of node names (default: all the connected nodes).
+# Returns {node: {'outputs': {cmd: output}, 'timings': {cmd: seconds}, 'latency': seconds, 'error': exception or None}}
+def execute_on_devices(nodes, commands, devices=None, max_workers=8):
+    if isinstance(commands, str):
+        commands = [commands]
+    if devices is None:
+        devices = [n for n in nodes if nodes[n] != '']
+    if not devices:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(devices))) as pool:
+        futures = {n: pool.submit(_execute_on_device, nodes[n], commands) for n in devices}
+    return {n: futures[n].result() for n in devices}
+
+
+# Open SSH clients shared by the file transfer helpers, keyed by (host, port, username).
+# Clients are kept alive with keepalives and closed once idle for SSH_POOL_IDLE_TIMEOUT seconds.
+SSH_POOL_IDLE_TIMEOUT = 300
+SSH_KEEPALIVE_INTERVAL = 30
+_ssh_pool = {}
+_ssh_pool_lock = threading.Lock()
+
+def _evict_idle_ssh_clients(now):
+    for key in list(_ssh_pool):
+        client, last_used = _ssh_pool[key]
+        transport = client.get_transport()
+        if now - last_used > SSH_POOL_IDLE_TIMEOUT or transport is None or not transport.is_active():
+            client.close()
+            del _ssh_pool[key]
+
+def _open_ssh_client(host, port, username, password):
     client = paramiko.SSHClient()
     # Set SSH key parameters to auto accept unknown hosts
     client.load_system_host_keys()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(hostname=rtr_ip, port=rtr_port, username='cisco', password='cisco123', allow_agent=False, look_for_keys=False)
+    client.connect(hostname=str(host), port=int(port), username=username, password=password, allow_agent=False, look_for_keys=False)
+    return client
+
+# The below function returns a connected SSH client from the pool, logging in only if needed.
+def get_ssh_client(host, port, username='cisco', password='cisco123'):
+    key = (str(host), int(port), username)
+    with _ssh_pool_lock:
+        _evict_idle_ssh_clients(time.time())
+        if key in _ssh_pool:
+            client = _ssh_pool[key][0]
+            _ssh_pool[key] = (client, time.time())
+            return client
+
+    client = _open_ssh_client(host, port, username, password)
+    client.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+
+    with _ssh_pool_lock:
+        if key in _ssh_pool:
+            # Another thread logged in first, keep its client
+            client.close()
+            client = _ssh_pool[key][0]
+        _ssh_pool[key] = (client, time.time())
+    return client
+
+# Interactive shells used by execute_batch(), keyed like the SSH client pool.
+# Each entry is [channel, prompt, lock].
+BATCH_SETUP_COMMANDS = ['export PAGER=cat']
+_batch_shells = {}
+
+_ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]|\r')
+
+def _read_until_count(chan, marker, count, timeout):
+    buf = ''
+    deadline = time.time() + timeout
+    while True:
+        out = _ANSI_ESCAPE.sub('', buf)
+        if out.count(marker) >= count:
+            return out
+        if time.time() > deadline:
+            raise TimeoutError("Timed out waiting for the prompt %r" % marker)
+        if chan.recv_ready():
+            buf += chan.recv(65536).decode(errors='replace')
+        elif chan.closed or chan.exit_status_ready():
+            raise EOFError("The shell was closed")
+        else:
+            time.sleep(0.01)
+
+def _read_until_prompt(chan, timeout):
+    buf = ''
+    deadline = time.time() + timeout
+    while not re.search(r'[#$>] ?$', _ANSI_ESCAPE.sub('', buf)):
+        if time.time() > deadline:
+            raise TimeoutError("Timed out waiting for the prompt")
+        if chan.recv_ready():
+            buf += chan.recv(65536).decode(errors='replace')
+        else:
+            time.sleep(0.01)
+    return _ANSI_ESCAPE.sub('', buf)
+
+def _open_batch_shell(host, port, username, password, timeout):
+    chan = get_ssh_client(host, port, username, password).invoke_shell(width=511)
+    _read_until_prompt(chan, timeout)
+    # The prompt is whatever the shell prints on the last line after an empty command
+    chan.send('\n')
+    prompt = _read_until_prompt(chan, timeout).split('\n')[-1]
+    for cmd in BATCH_SETUP_COMMANDS:
+        chan.send(cmd + '\n')
+        _read_until_count(chan, prompt, 1, timeout)
+    return [chan, prompt, threading.Lock()]
+
+def _split_batch_output(buf, prompt, commands):
+    results = {}
+    segments = buf.split(prompt)
+    for cmd, segment in zip(commands, segments):
+        lines = segment.split('\n')
+        # Drop the echo of the command itself
+        if lines and lines[0].strip().endswith(cmd.strip()):
+            lines = lines[1:]
+        results[cmd] = '\n'.join(lines).strip('\n')
+    return results
+
+# The below function sends a list of commands in one write over a persistent SSH shell
+# and splits the output back into {command: output} using the echoed prompt between commands.
+# The commands must not read from the terminal (no interactive confirmations).
+def execute_batch(host, port, commands, username='cisco', password='cisco123', timeout=120):
+    if isinstance(commands, str):
+        commands = [c.strip() for c in commands.splitlines() if c.strip()]
+    key = (str(host), int(port), username)
+    with _ssh_pool_lock:
+        shell = _batch_shells.get(key)
+    if shell is None or shell[0].closed:
+        shell = _open_batch_shell(host, port, username, password, timeout)
+        with _ssh_pool_lock:
+            _batch_shells[key] = shell
+
+    chan, prompt, lock = shell
+    with lock:
+        chan.send(''.join(cmd + '\n' for cmd in commands))
+        buf = _read_until_count(chan, prompt, len(commands), timeout)
+    return _split_batch_output(buf, prompt, commands)
+
+# The below function closes all the pooled SSH clients.
+def close_ssh_clients():
+    with _ssh_pool_lock:
+        for client, last_used in _ssh_pool.values():
+            client.close()
+        _ssh_pool.clear()
+        _batch_shells.clear()
+
+def copy_file_to_rtr(rtr_ip, rtr_port, src_file, dst_on_rtr):
+    client = get_ssh_client(rtr_ip, rtr_port)
     transfer = client.open_sftp()
     transfer.put(src_file, dst_on_rtr)
     transfer.close()
-    client.close()
     return
 
-def save_cfg_locally(rtr_ip, rtr_port, loc):
-    client = paramiko.SSHClient()
-    # Set SSH key parameters to auto accept unknown hosts
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(hostname=rtr_ip, port=rtr_port, username='cisco', password='cisco123', allow_agent=False, look_for_keys=False)
+def _upload_range(client, src_file, dst_on_rtr, offset, length, block_size, window_size):
+    sftp = paramiko.SFTPClient.from_transport(client.get_transport(), window_size=window_size, max_packet_size=32768)
+    try:
+        with open(src_file, 'rb') as local, sftp.open(dst_on_rtr, 'r+b') as remote:
+            # Send block_size writes without waiting for each acknowledgement
+            remote.MAX_REQUEST_SIZE = block_size
+            remote.set_pipelined(True)
+            local.seek(offset)
+            remote.seek(offset)
+            while length > 0:
+                data = local.read(min(block_size, length))
+                if not data:
+                    break
+                remote.write(data)
+                length -= len(data)
+    finally:
+        sftp.close()
+
+def _file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+# The below function uploads a large file (e.g. the telemetry pipeline binary) faster than copy_file_to_rtr().
+# block_size is the size of each SFTP write request. OpenSSH accepts requests of up to about 255 KB.
+# Up to window_size bytes are in flight on each channel.
+# channels > 1 splits the file into that many ranges, each written over its own SSH connection.
+# After the transfer the remote sha256sum (or the remote size, if sha256sum is not available) is checked.
+# Returns {'bytes': size, 'seconds': time, 'MBps': throughput, 'verified': 'sha256' or 'size'}
+def upload_file(rtr_ip, rtr_port, src_file, dst_on_rtr, username='cisco', password='cisco123',
+                block_size=131072, window_size=16 * 1024 * 1024, channels=1, verify=True):
+    size = os.path.getsize(src_file)
+    client = get_ssh_client(rtr_ip, rtr_port, username, password)
+    start = time.time()
+    # Create the remote file with its final size so that the ranges can be written in any order
+    sftp = client.open_sftp()
+    with sftp.open(dst_on_rtr, 'wb') as remote:
+        remote.truncate(size)
+    sftp.close()
+
+    channels = max(1, min(channels, size // block_size or 1))
+    chunk = -(-size // channels)
+    clients = [client] + [_open_ssh_client(rtr_ip, rtr_port, username, password) for i in range(channels - 1)]
+    try:
+        with ThreadPoolExecutor(max_workers=channels) as pool:
+            futures = [pool.submit(_upload_range, clients[i], src_file, dst_on_rtr, i * chunk,
+                                   min(chunk, size - i * chunk), block_size, window_size) for i in range(channels)]
+            for future in futures:
+                future.result()
+    finally:
+        for extra in clients[1:]:
+            extra.close()
+    seconds = time.time() - start
+
+    verified = None
+    if verify:
+        stdin, stdout, stderr = client.exec_command('sha256sum ' + shlex.quote(dst_on_rtr))
+        remote_hash = stdout.read().decode(errors='replace').split()
+        if stdout.channel.recv_exit_status() == 0 and remote_hash:
+            if remote_hash[0] != _file_sha256(src_file):
+                raise IOError("sha256 mismatch after uploading %s to %s" % (src_file, dst_on_rtr))
+            verified = 'sha256'
+        else:
+            sftp = client.open_sftp()
+            remote_size = sftp.stat(dst_on_rtr).st_size
+            sftp.close()
+            if remote_size != size:
+                raise IOError("Uploaded %d of %d bytes of %s" % (remote_size, size, src_file))
+            verified = 'size'
+
+    mbps = size / (1024 * 1024) / seconds if seconds > 0 else 0.0
+    print("File copied: %s -> %s, %.1f MB in %.1f sec (%.1f MB/s)" % (src_file, dst_on_rtr, size / (1024 * 1024), seconds, mbps))
+    return {'bytes': size, 'seconds': seconds, 'MBps': mbps, 'verified': verified}
+
+# Compressed transfers stream the file through 'gzip' or 'zstd' on the device over an SSH exec channel.
+# A file is only compressed when it is at least COMPRESS_MIN_SIZE bytes and a few samples of it
+# compress to at most COMPRESS_MAX_RATIO of their size; otherwise plain SFTP is used.
+COMPRESS_MIN_SIZE = 64 * 1024
+COMPRESS_MAX_RATIO = 0.8
+COMPRESS_SAMPLE_SIZE = 64 * 1024
+_remote_compressors = {}
+
+def _remote_compressor(client):
+    key = client.get_transport().getpeername()[:2]
+    if key not in _remote_compressors:
+        stdin, stdout, stderr = client.exec_command('command -v zstd; command -v gzip')
+        found = stdout.read().decode(errors='replace')
+        if zstandard is not None and 'zstd' in found:
+            _remote_compressors[key] = 'zstd'
+        elif 'gzip' in found:
+            _remote_compressors[key] = 'gzip'
+        else:
+            _remote_compressors[key] = None
+    return _remote_compressors[key]
+
+def _compresses_well(samples):
+    raw = b''.join(samples)
+    return len(raw) > 0 and len(zlib.compress(raw, 1)) <= COMPRESS_MAX_RATIO * len(raw)
+
+def _local_samples(path, size):
+    samples = []
+    with open(path, 'rb') as f:
+        for offset in sorted(set([0, size // 2, max(0, size - COMPRESS_SAMPLE_SIZE)])):
+            f.seek(offset)
+            samples.append(f.read(COMPRESS_SAMPLE_SIZE))
+    return samples
+
+def _compressor(method):
+    if method == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(3, zlib.DEFLATED, 31)
+
+def _decompressor(method):
+    if method == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
+
+def _exec_and_check(chan, cmd):
+    status = chan.recv_exit_status()
+    if status != 0:
+        err = chan.makefile_stderr('rb').read().decode(errors='replace')
+        raise IOError("'%s' failed with status %d: %s" % (cmd, status, err.strip()))
+
+# The below function copies a file to the device, compressing it on the fly when that pays off.
+# Returns the method used: 'zstd', 'gzip' or 'sftp'.
+def put_file_compressed(rtr_ip, rtr_port, src_file, dst_on_rtr, username='cisco', password='cisco123'):
+    client = get_ssh_client(rtr_ip, rtr_port, username, password)
+    size = os.path.getsize(src_file)
+    method = None
+    if size >= COMPRESS_MIN_SIZE and _compresses_well(_local_samples(src_file, size)):
+        method = _remote_compressor(client)
+    if method is None:
+        transfer = client.open_sftp()
+        transfer.put(src_file, dst_on_rtr)
+        transfer.close()
+        return 'sftp'
+
+    cmd = '%s -dc > %s' % (method, shlex.quote(dst_on_rtr))
+    chan = client.get_transport().open_session()
+    chan.exec_command(cmd)
+    compressor = _compressor(method)
+    with open(src_file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            chan.sendall(compressor.compress(block))
+    chan.sendall(compressor.flush())
+    chan.shutdown_write()
+    _exec_and_check(chan, cmd)
+    return method
+
+# The below function copies a file from the device, compressing it on the fly when that pays off.
+# Returns the method used: 'zstd', 'gzip' or 'sftp'.
+def get_file_compressed(rtr_ip, rtr_port, src_on_rtr, dst_file, username='cisco', password='cisco123'):
+    client = get_ssh_client(rtr_ip, rtr_port, username, password)
     transfer = client.open_sftp()
-    transfer.get("/etc/sonic/config_db.json", loc)
+    size = transfer.stat(src_on_rtr).st_size
+    method = None
+    if size >= COMPRESS_MIN_SIZE:
+        with transfer.open(src_on_rtr, 'rb') as remote:
+            sample = remote.read(COMPRESS_SAMPLE_SIZE)
+        if _compresses_well([sample]):
+            method = _remote_compressor(client)
+    if method is None:
+        transfer.get(src_on_rtr, dst_file)
+        transfer.close()
+        return 'sftp'
     transfer.close()
-    client.close()
+
+    cmd = '%s -c %s' % (method, shlex.quote(src_on_rtr))
+    chan = client.get_transport().open_session()
+    chan.exec_command(cmd)
+    decompressor = _decompressor(method)
+    with open(dst_file, 'wb') as f:
+        for block in iter(lambda: chan.recv(1024 * 1024), b''):
+            f.write(decompressor.decompress(block))
+        f.write(decompressor.flush())
+    _exec_and_check(chan, cmd)
+    return method
+
+def save_cfg_locally(rtr_ip, rtr_port, loc, compress=True):
+    if compress:
+        get_file_compressed(rtr_ip, rtr_port, "/etc/sonic/config_db.json", loc)
+    else:
+        client = get_ssh_client(rtr_ip, rtr_port)
+        transfer = client.open_sftp()
+        transfer.get("/etc/sonic/config_db.json", loc)
+        transfer.close()
     print ("File copied:", loc)
     return
+
+# Fabric snapshots of config_db.json are kept in a content-addressed store:
+#   <store_dir>/objects/<sha256[:2]>/<sha256>
+#                                 zlib-compressed canonical JSON of one subtree, in which the
+#                                 child subtrees that are stored as objects are replaced by {"$ref": sha256}
+#   <store_dir>/<name>.json       {"time": ..., "nodes": {node: sha256 of its config_db.json}}
+# Unchanged subtrees hash to the same object, so they are stored once across all snapshots and nodes.
+# Subtrees smaller than SNAPSHOT_MIN_OBJECT_SIZE bytes are kept inline in their parent.
+SNAPSHOT_MIN_OBJECT_SIZE = 1024
+
+def _store_json_tree(value, objects_dir, stats, root=False):
+    if not isinstance(value, dict):
+        return value
+    tree = {k: _store_json_tree(v, objects_dir, stats) for k, v in value.items()}
+    data = json.dumps(tree, sort_keys=True, separators=(',', ':')).encode()
+    if len(data) < SNAPSHOT_MIN_OBJECT_SIZE and not root:
+        return tree
+    sha = hashlib.sha256(data).hexdigest()
+    path = os.path.join(objects_dir, sha[:2], sha)
+    if os.path.exists(path):
+        stats['reused'] += 1
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        packed = zlib.compress(data)
+        tmp_file = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'wb') as f:
+            f.write(packed)
+        os.replace(tmp_file, path)
+        stats['new'] += 1
+        stats['bytes'] += len(packed)
+    return {'$ref': sha}
+
+def _load_json_tree(value, objects_dir):
+    if not isinstance(value, dict):
+        return value
+    if list(value) == ['$ref']:
+        sha = value['$ref']
+        with open(os.path.join(objects_dir, sha[:2], sha), 'rb') as f:
+            value = json.loads(zlib.decompress(f.read()))
+    return {k: _load_json_tree(v, objects_dir) for k, v in value.items()}
+
+def _snapshot_node(device, objects_dir):
+    start = time.time()
+    stats = {'new': 0, 'reused': 0, 'bytes': 0}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        loc = os.path.join(tmp_dir, 'config_db.json')
+        get_file_compressed(device.connections.cli.ip, device.connections.cli.port, "/etc/sonic/config_db.json", loc)
+        with open(loc) as f:
+            config = json.load(f)
+    root = _store_json_tree(config, objects_dir, stats, root=True)['$ref']
+    stats['seconds'] = time.time() - start
+    return root, stats
+
+# The below function saves the config_db.json of several SONiC nodes at the same time into a snapshot.
+# devices is a list of node names (default: all the nodes except trex).
+# The default name is the time in milliseconds. An existing snapshot is never overwritten.
+# Returns the snapshot name, to be used with load_snapshot().
+def snapshot_fabric(nodes, devices=None, store_dir='snapshots', name=None, max_workers=8):
+    if devices is None:
+        devices = [n for n in nodes if n != 'trex']
+    if not devices:
+        raise ValueError("No devices to snapshot")
+    if name is None:
+        now = time.time()
+        name = time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + '.%03d' % (now % 1 * 1000)
+    path = os.path.join(store_dir, name + '.json')
+    if os.path.exists(path):
+        raise FileExistsError("The snapshot %s already exists" % name)
+    objects_dir = os.path.join(store_dir, 'objects')
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(devices))) as pool:
+        futures = {n: pool.submit(_snapshot_node, nodes[n], objects_dir) for n in devices}
+    snapshot = {'time': time.time(), 'nodes': {}}
+    for n in devices:
+        root, stats = futures[n].result()
+        snapshot['nodes'][n] = root
+        print("%-10s saved in %.1f sec, %d new objects (%d bytes), %d unchanged" %
+              (n, stats['seconds'], stats['new'], stats['bytes'], stats['reused']))
+
+    # 'x' fails if another snapshot of the same name was saved in the meantime
+    with open(path, 'x') as f:
+        json.dump(snapshot, f, indent=1)
+    print("Snapshot saved:", name)
+    return name
+
+# The below function returns the config_db.json of a node from a snapshot, and writes it to loc if given.
+def load_snapshot(name, node, store_dir='snapshots', loc=None):
+    with open(os.path.join(store_dir, name + '.json')) as f:
+        snapshot = json.load(f)
+    config = _load_json_tree({'$ref': snapshot['nodes'][node]}, os.path.join(store_dir, 'objects'))
+    if loc is not None:
+        with open(loc, 'w') as f:
+            json.dump(config, f, indent=4, sort_keys=True)
+    return config
@@ -3,11 +3,1000 @@
 # Sarah Samuel (sasamuel@cisco.com)
 # DATE: 08 September 2020
 
+import os
+import re
+import json
+import shlex
+import socket
+import hashlib
+import time
+import threading
+import collections
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
 import paramiko
-from paramiko_expect import SSHClientInteraction
 PROMPT = '.*root.*'
 TREX_PROMPT = '.*trex.*'
 
+# Hashes of the files uploaded to each server, so that unchanged files are not copied again.
+# Maps 'host:port' to {remote_path: {'sha256': ..., 'size': ..., 'mtime': ...}}
+UPLOAD_MANIFEST = os.path.join(os.path.expanduser('~'), '.cache', 'network-notebooks', 'upload_manifest.json')
+# put_files() is called from several threads at once by TrafficFleet and get_trex_server
+_upload_manifest_lock = threading.Lock()
+
+def _load_manifest():
+    try:
+        with open(UPLOAD_MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+# The below function copies files to a server over SFTP, skipping the files that are unchanged.
+# files is a list of (local_path, remote_path).
+# A file is skipped when its hash matches the manifest and the remote size and mtime still match
+# what was recorded after the last upload, which a single 'stat' on the server checks for all files.
+def put_files(client, files):
+    host, port = client.get_transport().getpeername()[:2]
+    server = '%s:%s' % (host, port)
+    with _upload_manifest_lock:
+        host_manifest = _load_manifest().get(server, {})
+
+    hashes = {remote: _sha256(local) for local, remote in files}
+    candidates = [remote for local, remote in files if host_manifest.get(remote, {}).get('sha256') == hashes[remote]]
+    remote_stat = {}
+    if candidates:
+        stdin, stdout, stderr = client.exec_command('stat -c "%s %Y %n" ' + ' '.join(shlex.quote(r) for r in candidates))
+        for line in stdout.read().decode(errors='replace').splitlines():
+            fields = line.split(' ', 2)
+            if len(fields) == 3 and fields[0].isdigit() and fields[1].isdigit():
+                remote_stat[fields[2]] = [int(fields[0]), int(fields[1])]
+
+    transfer = None
+    uploaded = {}
+    for local, remote in files:
+        entry = host_manifest.get(remote, {})
+        if remote in candidates and remote_stat.get(remote) == [entry.get('size'), entry.get('mtime')]:
+            print("Unchanged, not copied:", remote)
+            continue
+        if transfer is None:
+            transfer = client.open_sftp()
+        transfer.put(local, remote)
+        attrs = transfer.stat(remote)
+        uploaded[remote] = {'sha256': hashes[remote], 'size': attrs.st_size, 'mtime': int(attrs.st_mtime)}
+    if transfer is None:
+        return
+    transfer.close()
+
+    # Merge the uploads into the current manifest, which other threads or notebooks may have changed meanwhile
+    with _upload_manifest_lock:
+        manifest = _load_manifest()
+        manifest.setdefault(server, {}).update(uploaded)
+        os.makedirs(os.path.dirname(UPLOAD_MANIFEST), exist_ok=True)
+        tmp_file = '%s.%d.%d' % (UPLOAD_MANIFEST, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_file, UPLOAD_MANIFEST)
+
+
+_ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;?]*[a-zA-Z]')
+
+# Interactive shell on an SSH client, used like paramiko_expect.SSHClientInteraction (send, expect,
+# current_output, close), for the shells that stay open during long traffic runs.
+# A background thread reads everything the server prints, so the SSH channel never stops the server
+# when its window is full, and keeps only the last max_buffer bytes that expect() has not consumed yet.
+# The output can also be written to log_file, which is rotated when it reaches log_max_bytes, with
+# log_backups old files kept (log_file.1, log_file.2, ...).
+class ExpectSession(object):
+
+    def __init__(self, client, timeout=60, display=True, max_buffer=1024 * 1024,
+                 log_file=None, log_max_bytes=10 * 1024 * 1024, log_backups=3):
+        self.timeout = timeout
+        self.display = display
+        self.max_buffer = max_buffer
+        self.chunks = collections.deque()
+        self.buffered = 0
+        self.dropped = 0
+        self.eof = False
+        self.cond = threading.Condition()
+        self.current_output = ''
+        self.current_output_clean = ''
+        self.log_file = log_file
+        self.log_max_bytes = log_max_bytes
+        self.log_backups = log_backups
+        self.log = open(log_file, 'ab') if log_file else None
+        self.channel = client.invoke_shell(width=200)
+        self.reader = threading.Thread(target=self._reader, daemon=True)
+        self.reader.start()
+
+    def _write_log(self, data):
+        if self.log.tell() + len(data) > self.log_max_bytes:
+            self.log.close()
+            for i in range(self.log_backups - 1, 0, -1):
+                if os.path.exists('%s.%d' % (self.log_file, i)):
+                    os.replace('%s.%d' % (self.log_file, i), '%s.%d' % (self.log_file, i + 1))
+            if self.log_backups > 0:
+                os.replace(self.log_file, self.log_file + '.1')
+            self.log = open(self.log_file, 'wb')
+        self.log.write(data)
+        self.log.flush()
+
+    def _reader(self):
+        while True:
+            try:
+                data = self.channel.recv(65536)
+            except (OSError, EOFError, paramiko.SSHException):
+                data = b''
+            if self.log is not None and data:
+                self._write_log(data)
+            with self.cond:
+                if not data:
+                    self.eof = True
+                    self.cond.notify_all()
+                    return
+                self.chunks.append(data)
+                self.buffered += len(data)
+                # Drop the oldest output beyond max_buffer
+                while self.buffered > self.max_buffer and len(self.chunks) > 1:
+                    self.buffered -= len(self.chunks[0])
+                    self.dropped += len(self.chunks.popleft())
+                self.cond.notify_all()
+
+    def send(self, cmd, newline='\n'):
+        self.channel.sendall((cmd + newline).encode())
+
+    def _consume(self):
+        output = b''.join(self.chunks).decode(errors='replace')
+        self.chunks.clear()
+        self.buffered = 0
+        self.current_output = output
+        self.current_output_clean = _ANSI_ESCAPE.sub('', output).replace('\r', '')
+        if self.display:
+            print(self.current_output_clean, end='' if self.current_output_clean.endswith('\n') else '\n')
+
+    # Waits until the output since the last expect() matches one of the regular expressions
+    # (matched from the start, with . matching newlines) and returns its index.
+    # Without regular expressions, waits until the session is closed and returns 0.
+    # Raises TimeoutError on timeout and EOFError when the session is closed before a match,
+    # with the end of the output in the message.
+    def expect(self, re_strings='', timeout=None):
+        if isinstance(re_strings, str):
+            re_strings = [re_strings] if re_strings else []
+        patterns = [re.compile(r, re.DOTALL) for r in re_strings]
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        with self.cond:
+            while True:
+                if patterns and self.chunks:
+                    text = _ANSI_ESCAPE.sub('', b''.join(self.chunks).decode(errors='replace'))
+                    for i, pattern in enumerate(patterns):
+                        if pattern.match(text):
+                            self._consume()
+                            return i
+                remaining = deadline - time.time()
+                if self.eof or remaining <= 0:
+                    self._consume()
+                    if self.eof and not patterns:
+                        return 0
+                    error = EOFError if self.eof else TimeoutError
+                    raise error("No match for %r in the output:\n%s" % (re_strings, self.current_output_clean[-500:]))
+                self.cond.wait(remaining)
+
+    # The output not consumed by expect() yet, without consuming it
+    def tail(self, size=4096):
+        with self.cond:
+            return b''.join(self.chunks)[-size:].decode(errors='replace')
+
+    def close(self):
+        self.channel.close()
+        self.reader.join(5)
+        if self.log is not None:
+            self.log.close()
+
+
+TREX_DIR = '/opt/cisco/trex/latest'
+
+class STLError(Exception):
+    pass
+
+# JSON turns int keys into strings, turn them back
+def _int_keys(value):
+    if isinstance(value, dict):
+        return {int(k) if isinstance(k, str) and k.isdigit() else k: _int_keys(v) for k, v in value.items()}
+    return value
+
+# Session with the TREX STL Python API, as an alternative to typing commands in trex-console.
+# The STL API runs on the TREX server in stl_agent.py, started over an SSH channel of client,
+# so start, stop, update and stats are single calls instead of matching the console output.
+# The STL API needs the TREX server to be running, e.g. './t-rex-64 -i'.
+# server and sync_port select the RPC server the agent talks to (default: the local TREX server).
+class STLSession(object):
+
+    def __init__(self, client, server='127.0.0.1', sync_port=4501, async_port=4500, python='python3', timeout=60, wait=0):
+        put_files(client, [("traffic/stl_agent.py", TREX_DIR + "/stl_agent.py")])
+        self.client = client
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.errors = collections.deque(maxlen=50)
+        self.chan = client.get_transport().open_session()
+        self.chan.settimeout(timeout)
+        self.chan.exec_command('cd %s && %s -u stl_agent.py --server %s --sync-port %d --async-port %d' %
+                               (TREX_DIR, python, shlex.quote(server), sync_port, async_port))
+        self.replies = self.chan.makefile('rb')
+        # Keep the last lines of the agent's stderr for the error messages, the rest is dropped
+        threading.Thread(target=self._drain_stderr, daemon=True).start()
+        self.connect(wait)
+
+    # Connect to the TREX server, retrying for up to wait seconds while it is starting
+    def connect(self, wait=0):
+        deadline = time.time() + wait
+        while True:
+            try:
+                self.version = self.call('connect')
+                return self.version
+            except STLError:
+                if time.time() >= deadline:
+                    raise
+                time.sleep(1)
+
+    def _drain_stderr(self):
+        # The timeout of the channel also applies to its stderr, which is often silent for longer
+        stderr = self.chan.makefile_stderr('rb')
+        while True:
+            try:
+                line = stderr.readline()
+            except socket.timeout:
+                continue
+            if not line:
+                return
+            self.errors.append(line.decode(errors='replace').rstrip())
+
+    def call(self, cmd, **args):
+        with self.lock:
+            self.next_id += 1
+            self.chan.sendall((json.dumps({'id': self.next_id, 'cmd': cmd, 'args': args}) + '\n').encode())
+            # The late replies of earlier calls that timed out come first: skip them, and the rest
+            # of a reply line cut by a timeout, until the reply to this call
+            while True:
+                line = self.replies.readline()
+                if not line:
+                    raise STLError("The STL agent exited: " + '\n'.join(self.errors))
+                try:
+                    reply = json.loads(line.decode(errors='replace'))
+                except ValueError:
+                    continue
+                if isinstance(reply, dict) and reply.get('id') == self.next_id:
+                    break
+        if 'error' in reply:
+            raise STLError(reply['error'])
+        return reply['result']
+
+    # Start a profile of the stl/ directory, like 'start -f stl/traffic_3st.py -d 1h -m 100pps -p 0'.
+    # duration is in seconds, -1 runs until stop() is called.
+    # With profile=None, the streams of the last load() are started.
+    def start(self, profile, ports=[0], mult='100pps', duration=-1, **tunables):
+        return self.call('start', profile=profile, ports=ports, mult=mult, duration=duration, tunables=tunables)
+
+    # Put the streams of a profile on the ports without starting them
+    def load(self, profile, ports=[0], **tunables):
+        return self.call('load', profile=profile, ports=ports, tunables=tunables)
+
+    def stop(self, ports=None):
+        return self.call('stop', ports=ports)
+
+    # Change the rate of the running traffic, e.g. update('1kpps') or update('50%')
+    def update(self, mult, ports=None):
+        return self.call('update', mult=mult, ports=ports)
+
+    # Returns the counters of the STL API, with the port numbers as int keys and 'global' and 'total'
+    def get_stats(self, ports=None):
+        return _int_keys(self.call('stats', ports=ports))
+
+    # Returns the per-stream counters ('flow_stats') and latency ('latency') of the streams with flow_stats,
+    # with the pg_ids and port numbers as int keys
+    def get_pgid_stats(self, pg_ids=None):
+        return _int_keys(self.call('pgid_stats', pg_ids=pg_ids))
+
+    def clear_stats(self, ports=None):
+        return self.call('clear_stats', ports=ports)
+
+    def is_traffic_active(self, ports=None):
+        return self.call('is_traffic_active', ports=ports)
+
+    def close(self):
+        try:
+            self.call('disconnect')
+        except (STLError, OSError):
+            pass
+        self.chan.close()
+
+
+# Interfaces of the TREX server before they are bound to DPDK, and the PCI addresses of the data ports
+TREX_IFCONFIG = 'ifconfig eth1 10.0.5.2 netmask 255.255.255.0 up; ifconfig eth2 10.0.6.2 netmask 255.255.255.0 up'
+TREX_PCI_PORTS = ['00:04.0', '00:05.0']
+TREX_SERVER_LOG = '/tmp/trex-server.log'
+# Modules imported by the profiles, copied to the stl/ directory of the server with them
+STL_HELPERS_DIR = os.path.dirname(os.path.abspath(__file__))
+# image_version.py of the SONiC images, in lib/
+IMAGE_VERSION_FILE = os.path.join(os.path.dirname(STL_HELPERS_DIR), 'lib', 'image_version.py')
+
+# Shell script that stops the TREX server and gives the data ports back to the kernel, in one round trip
+def trex_teardown_script():
+    cmds = ['cd ' + TREX_DIR, 'sudo pkill -x _t-rex-64',
+            # Wait up to 10 sec for the server to release the ports
+            'for i in $(seq 50); do pgrep -x _t-rex-64 > /dev/null || break; sleep 0.2; done']
+    cmds += ['sudo ./dpdk_nic_bind.py --force -u ' + pci for pci in TREX_PCI_PORTS]
+    cmds += ['sudo ./dpdk_nic_bind.py --bind=virtio-pci ' + pci for pci in TREX_PCI_PORTS]
+    return '; '.join(cmds)
+
+_trex_servers = {}
+_trex_servers_locks = {}
+_trex_servers_lock = threading.Lock()
+
+# A TREX server in stateless mode ('./t-rex-64 -i') that keeps running between traffic runs.
+# The server is started in the background on the traffic generator, so it also survives a restart
+# of the notebook kernel: start() finds it running and only reconnects the STL API to it.
+# Each traffic profile takes the ports it needs with acquire() and gives them back with release().
+class TRexServer(object):
+
+    def __init__(self, trexipaddress, trexport, username='root', password='cisco123'):
+        self.address = (trexipaddress, trexport)
+        self.client = paramiko.SSHClient()
+        # Set SSH key parameters to auto accept unknown hosts
+        self.client.load_system_host_keys()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.connect(hostname=trexipaddress, port=trexport, username=username, password=password)
+        self.client.get_transport().set_keepalive(30)
+        self.stl = None
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def _run(self, cmd, timeout=60):
+        stdin, stdout, stderr = self.client.exec_command(cmd, timeout=timeout)
+        return (stdout.read() + stderr.read()).decode(errors='replace')
+
+    def is_running(self):
+        return self._run('pgrep -x _t-rex-64').strip() != ''
+
+    # Starts the server unless it is already running, and connects the STL API to it
+    def start(self, timeout=120):
+        start_time = time.time()
+        if not self.is_running():
+            put_files(self.client, [("traffic/trex_cfg.yaml", "/etc/trex_cfg.yaml")])
+            self._run('%s; cd %s && (nohup ./t-rex-64 -i > %s 2>&1 < /dev/null &)' % (TREX_IFCONFIG, TREX_DIR, TREX_SERVER_LOG))
+        if self.stl is None:
+            self.stl = STLSession(self.client, wait=timeout)
+        else:
+            self.stl.connect(wait=timeout)
+        print("TREX server %s ready in %.1f sec" % (self.stl.version.get('version', ''), time.time() - start_time))
+        return self
+
+    # True if the server process runs and answers on its RPC port
+    def is_healthy(self):
+        try:
+            return self.is_running() and self.stl is not None and bool(self.stl.call('version'))
+        except (STLError, OSError, paramiko.SSHException):
+            return False
+
+    # Takes ports that no TRexPorts of this server holds. The TREX server refuses ports that another
+    # session owns, e.g. another notebook on the same TREX server. force=True takes them anyway, which
+    # stops that session's traffic. The agent releases its ports when its SSH channel closes, so a
+    # restarted kernel does not need it.
+    def acquire(self, ports=[0], force=False):
+        with self.lock:
+            busy = [p for p in ports if p in self.owners]
+            if busy:
+                raise STLError("TREX ports %s are already in use" % busy)
+            self.stl.call('acquire', ports=ports, force=force)
+            handle = TRexPorts(self, ports)
+            for p in ports:
+                self.owners[p] = handle
+        return handle
+
+    def release(self, handle):
+        with self.lock:
+            ports = [p for p in handle.ports if self.owners.get(p) is handle]
+            if ports:
+                self.stl.stop(ports=ports)
+                self.stl.call('release', ports=ports)
+            for p in ports:
+                del self.owners[p]
+
+    # Closes the sessions to the server, which keeps running for the next traffic runs
+    def close(self):
+        if self.stl is not None:
+            self.stl.close()
+            self.stl = None
+        self.client.close()
+
+    # Stops the server and gives the data ports back to the kernel
+    def shutdown(self):
+        if self.stl is not None:
+            try:
+                self.stl.stop()
+            except (STLError, OSError):
+                pass
+        self._run(trex_teardown_script())
+        self.owners.clear()
+        self.close()
+
+
+# The ports of a TREX server taken by one traffic profile. Use it as a context manager to
+# release the ports at the end of a with block.
+class TRexPorts(object):
+
+    def __init__(self, server, ports):
+        self.server = server
+        self.ports = list(ports)
+
+    # Copies a local profile file to the stl/ directory of the server if it changed, returns its path there
+    def upload(self, profile):
+        remote = 'stl/' + os.path.basename(profile)
+        put_files(self.server.client, [(profile, TREX_DIR + '/' + remote),
+                                       (os.path.join(STL_HELPERS_DIR, 'pkt_cache.py'), TREX_DIR + '/stl/pkt_cache.py'),
+                                       (os.path.join(STL_HELPERS_DIR, 'size_mix.py'), TREX_DIR + '/stl/size_mix.py')])
+        return remote
+
+    # profile is a local profile file, see upload(), or None to start the streams of the last load()
+    def start(self, profile, mult='100pps', duration=-1, **tunables):
+        remote = self.upload(profile) if profile is not None else None
+        return self.server.stl.start(remote, ports=self.ports, mult=mult, duration=duration, **tunables)
+
+    def load(self, profile, **tunables):
+        return self.server.stl.load(self.upload(profile), ports=self.ports, **tunables)
+
+    def stop(self):
+        return self.server.stl.stop(ports=self.ports)
+
+    def update(self, mult):
+        return self.server.stl.update(mult, ports=self.ports)
+
+    def get_stats(self):
+        return self.server.stl.get_stats(ports=self.ports)
+
+    def get_pgid_stats(self, pg_ids=None):
+        return self.server.stl.get_pgid_stats(pg_ids)
+
+    def clear_stats(self):
+        return self.server.stl.clear_stats(ports=self.ports)
+
+    def release(self):
+        self.server.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# The below function returns the running TREX server of a traffic generator, starting it if needed.
+# The same server is returned to every traffic run on that traffic generator.
+def get_trex_server(trexipaddress, trexport):
+    key = (trexipaddress, trexport)
+    # One lock per traffic generator, so that several servers can be started at the same time
+    with _trex_servers_lock:
+        lock = _trex_servers_locks.setdefault(key, threading.Lock())
+    with lock:
+        server = _trex_servers.get(key)
+        if server is None or not server.is_healthy():
+            if server is not None:
+                server.close()
+            server = _trex_servers[key] = TRexServer(trexipaddress, trexport)
+            server.start()
+    return server
+
+
+# Counters sampled by StatsSampler for each port, and for the whole server ('global')
+SAMPLER_PORT_COUNTERS = ['opackets', 'ipackets', 'obytes', 'ibytes', 'tx_pps', 'rx_pps', 'tx_bps', 'rx_bps']
+SAMPLER_GLOBAL_COUNTERS = ['tx_pps', 'rx_pps', 'tx_bps', 'rx_bps', 'rx_drop_bps', 'cpu_util']
+
+# Polls the TREX counters every interval seconds in a background thread.
+# source is an STLSession or the TRexPorts of a profile, anything with a get_stats() method.
+# A metric is the path of a counter in get_stats(), e.g. (0, 'opackets'), ('global', 'tx_pps') or
+# ('flow_stats', 7, 'rx_pkts', 'total'). Each metric has its own NumPy ring buffer, allocated up front
+# with room for max_memory bytes in total, so a long run keeps the most recent samples in a fixed
+# amount of memory. Counters that are missing from a sample are stored as NaN.
+# The 'flow_stats' and 'latency' metrics are also polled with get_pgid_stats() for their pg_ids, since
+# newer TREX releases only report the per-stream counters there.
+class StatsSampler(object):
+
+    def __init__(self, source, ports=[0], interval=0.1, max_memory=16 * 1024 * 1024, metrics=None):
+        import numpy as np
+        self.np = np
+        self.source = source
+        self.interval = interval
+        if metrics is None:
+            metrics = [(p, c) for p in ports for c in SAMPLER_PORT_COUNTERS]
+            metrics += [('global', c) for c in SAMPLER_GLOBAL_COUNTERS]
+        self.metrics = [tuple(m) for m in metrics]
+        self.pg_ids = sorted(set(int(m[1]) for m in self.metrics if len(m) > 1 and m[0] in ('flow_stats', 'latency')))
+        # One float64 per metric and per timestamp for each sample
+        self.capacity = max(2, max_memory // (8 * (len(self.metrics) + 1)))
+        self.timestamps = np.full(self.capacity, np.nan)
+        self.buffers = {m: np.full(self.capacity, np.nan) for m in self.metrics}
+        self.count = 0
+        self.errors = 0
+        self.last_error = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def _lookup(self, stats, metric):
+        value = stats
+        for key in metric:
+            if not isinstance(value, dict):
+                return self.np.nan
+            value = value.get(key, value.get(str(key), self.np.nan))
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return self.np.nan
+
+    # Takes one sample now
+    def sample(self):
+        timestamp = time.time()
+        stats = self.source.get_stats()
+        if self.pg_ids and hasattr(self.source, 'get_pgid_stats'):
+            stats = dict(stats)
+            stats.update(self.source.get_pgid_stats(self.pg_ids))
+        i = self.count % self.capacity
+        self.timestamps[i] = timestamp
+        for m in self.metrics:
+            self.buffers[m][i] = self._lookup(stats, m)
+        self.count += 1
+
+    def _loop(self):
+        next_time = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+            # Keep the sampling times on the interval grid, skipping the samples that are late
+            next_time += self.interval
+            now = time.monotonic()
+            if next_time < now:
+                next_time += ((now - next_time) // self.interval + 1) * self.interval
+            self.stop_event.wait(next_time - now)
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _ordered(self, buffer):
+        # The samples from oldest to newest
+        if self.count <= self.capacity:
+            return buffer[:self.count].copy()
+        i = self.count % self.capacity
+        return self.np.concatenate((buffer[i:], buffer[:i]))
+
+    def times(self):
+        return self._ordered(self.timestamps)
+
+    def values(self, metric):
+        return self._ordered(self.buffers[tuple(metric)])
+
+    # Increase of a counter between consecutive samples
+    def delta(self, metric):
+        return self.np.diff(self.values(metric))
+
+    # Per-second rate of a counter between consecutive samples, e.g. rate((0, 'opackets')) for the
+    # packets per second sent on port 0. Counter resets (clear_stats) give a rate of 0.
+    def rate(self, metric):
+        return self.np.clip(self.delta(metric), 0, None) / self.np.diff(self.times())
+
+    def percentile(self, metric, q, rate=False):
+        values = self.rate(metric) if rate else self.values(metric)
+        return self.np.nanpercentile(values, q)
+
+    # min/avg/max and percentiles of every metric, or of the rate of the metrics that are counters
+    def summary(self, rate_of=('opackets', 'ipackets', 'obytes', 'ibytes')):
+        result = {}
+        for m in self.metrics:
+            values = self.rate(m) if m[-1] in rate_of else self.values(m)
+            if len(values) == 0 or self.np.all(self.np.isnan(values)):
+                continue
+            p50, p95, p99 = self.np.nanpercentile(values, [50, 95, 99])
+            result[m] = {'min': float(self.np.nanmin(values)), 'avg': float(self.np.nanmean(values)),
+                         'max': float(self.np.nanmax(values)), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+        return result
+
+
+# Latency histogram with a fixed number of buckets, like an HDR histogram: values below sub_buckets usec
+# have their own bucket, and above that every power of two is split into sub_buckets / 2 buckets, so
+# every value is stored within 2 / sub_buckets of its value (1.6% with 128) up to max_usec.
+# Larger values are counted in the last bucket.
+class LatencyHistogram(object):
+
+    def __init__(self, max_usec=10 ** 7, sub_buckets=128):
+        import numpy as np
+        self.np = np
+        self.sub_buckets = sub_buckets
+        self.shift = sub_buckets.bit_length() - 1
+        self.max_usec = max_usec
+        self.counts = np.zeros(self._index(max_usec) + 1, dtype=np.int64)
+        self.total = 0
+
+    def _index(self, value):
+        value = int(value)
+        if value < self.sub_buckets:
+            return max(value, 0)
+        exponent = value.bit_length() - self.shift
+        half = self.sub_buckets // 2
+        return self.sub_buckets + (exponent - 1) * half + (value >> exponent) - half
+
+    def _value(self, index):
+        # Lowest value of a bucket
+        if index < self.sub_buckets:
+            return index
+        half = self.sub_buckets // 2
+        exponent, offset = divmod(index - self.sub_buckets, half)
+        return (offset + half) << (exponent + 1)
+
+    def record(self, value_usec, count=1):
+        self.counts[min(self._index(value_usec), len(self.counts) - 1)] += count
+        self.total += count
+
+    def percentile(self, q):
+        if self.total == 0:
+            return None
+        rank = max(1, int(self.np.ceil(self.total * q / 100.0)))
+        return self._value(int(self.np.searchsorted(self.np.cumsum(self.counts), rank)))
+
+    def reset(self):
+        self.counts[:] = 0
+        self.total = 0
+
+
+# Collects the latency of the latency-tagged streams of the profiles (flow_stats=STLFlowLatencyStats(pg_id)).
+# source is an STLSession or TRexPorts. Every poll() moves the new packets of the TREX latency histogram of
+# each pg_id into a LatencyHistogram, and keeps the min/avg/max latency, jitter and error counters of TREX.
+# names gives a label to each pg_id, e.g. {1: 'EF', 2: 'best effort'}.
+class LatencyMonitor(object):
+
+    def __init__(self, source, pg_ids, names=None, interval=1.0, max_usec=10 ** 7):
+        self.source = source
+        self.pg_ids = list(pg_ids)
+        self.names = names or {}
+        self.interval = interval
+        self.histograms = {pg_id: LatencyHistogram(max_usec) for pg_id in self.pg_ids}
+        self.last_buckets = {pg_id: {} for pg_id in self.pg_ids}
+        self.latest = {pg_id: {} for pg_id in self.pg_ids}
+        self.max_jitter = {pg_id: 0 for pg_id in self.pg_ids}
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def poll(self):
+        stats = self.source.get_pgid_stats(self.pg_ids)
+        for pg_id in self.pg_ids:
+            latency = stats.get('latency', {}).get(pg_id, {})
+            lat = latency.get('latency', {})
+            flow = stats.get('flow_stats', {}).get(pg_id, {})
+            buckets = lat.get('histogram', {})
+            last = self.last_buckets[pg_id]
+            for bucket, count in buckets.items():
+                new = count - last.get(bucket, 0)
+                if new < 0:
+                    # The counters were cleared since the last poll
+                    new = count
+                if new:
+                    self.histograms[pg_id].record(bucket, new)
+            self.last_buckets[pg_id] = dict(buckets)
+            self.max_jitter[pg_id] = max(self.max_jitter[pg_id], lat.get('jitter', 0))
+            self.latest[pg_id] = {'min_usec': lat.get('total_min'), 'avg_usec': lat.get('average'),
+                                  'max_usec': lat.get('total_max'), 'jitter_usec': lat.get('jitter'),
+                                  'tx_pkts': flow.get('tx_pkts', {}).get('total'),
+                                  'rx_pkts': flow.get('rx_pkts', {}).get('total'),
+                                  'errors': latency.get('err_cntrs', {})}
+
+    def _loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except (STLError, OSError):
+                pass
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.poll()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def summary(self):
+        result = {}
+        for pg_id in self.pg_ids:
+            row = {'name': self.names.get(pg_id, str(pg_id))}
+            row.update(self.latest[pg_id])
+            row['max_jitter_usec'] = self.max_jitter[pg_id]
+            for q in (50, 90, 99, 99.9):
+                row['p%s_usec' % q] = self.histograms[pg_id].percentile(q)
+            result[pg_id] = row
+        return result
+
+    # Prints the latency of the streams side by side, e.g. a prioritized and a best-effort class
+    def compare(self):
+        summary = self.summary()
+        print("%-16s %10s %10s %10s %10s %10s %10s %10s" % ('Stream', 'min', 'avg', 'max', 'jitter', 'p50', 'p99', 'p99.9'))
+        for pg_id, row in summary.items():
+            print("%-16s %10s %10s %10s %10s %10s %10s %10s" % (row['name'], row['min_usec'], row['avg_usec'], row['max_usec'],
+                  row['jitter_usec'], row['p50_usec'], row['p99_usec'], row['p99.9_usec']))
+        return summary
+
+
+_RATE_MULT = re.compile(r'^([0-9.]+)([kmgKMG]?)(pps|bps|bpsl1)$')
+
+# Share of an absolute rate ('100kpps', '1gbps'); a relative rate ('50%', '2') is the same on every generator
+def _split_mult(mult, share):
+    match = _RATE_MULT.match(str(mult))
+    if not match:
+        return mult
+    return '%g%s%s' % (float(match.group(1)) * share, match.group(2), match.group(3))
+
+# Splits the IP range 'first-last' into consecutive ranges, one per share, each with at least one address
+def _split_ip_range(ip_range, shares):
+    first, _, last = str(ip_range).partition('-')
+    first = int(ipaddress.ip_address(first))
+    last = int(ipaddress.ip_address(last or first))
+    size = last - first + 1
+    if size < len(shares):
+        raise ValueError("The range %s has %d addresses, fewer than the %d traffic generators" %
+                         (ip_range, size, len(shares)))
+    ranges = []
+    start = first
+    for i in range(len(shares)):
+        # Leave at least one address for each of the next shares
+        end = first + int(round(size * sum(shares[:i + 1]))) - 1
+        end = last if i == len(shares) - 1 else min(max(end, start), last - (len(shares) - 1 - i))
+        ranges.append('%s-%s' % (ipaddress.ip_address(start), ipaddress.ip_address(end)))
+        start = end + 1
+    return ranges
+
+# Sum of the counters of several get_stats() sections; the utilizations are averaged instead
+def _merge_counters(sections):
+    merged = {}
+    for section in sections:
+        for key, value in section.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+    for key in merged:
+        if 'util' in key:
+            merged[key] = float(merged[key]) / len(sections)
+    return merged
+
+# Several TREX traffic generators driven as one. endpoints is a list of (ip address, ssh port) of the
+# traffic generators, each of which gets a warm TREX server (get_trex_server) with ports acquired.
+# start() splits the rate, and the flows of the profiles with a flows/src tunable, between the generators
+# according to weights, and starts them together: the start requests are sent so that they reach the
+# generators at the same time, given the round trip time to each one, and the traffic is stopped
+# if the measured start times are further apart than max_skew seconds.
+# get_stats() adds up the counters of all the generators.
+class TrafficFleet(object):
+
+    def __init__(self, endpoints, ports=[0], weights=None, max_skew=0.05):
+        self.endpoints = [tuple(e) for e in endpoints]
+        self.max_skew = max_skew
+        weights = weights or [1] * len(self.endpoints)
+        self.shares = [float(w) / sum(weights) for w in weights]
+        self.pool = ThreadPoolExecutor(max_workers=len(self.endpoints))
+        self.handles = []
+        try:
+            self.servers = list(self.pool.map(lambda e: get_trex_server(*e), self.endpoints))
+            for server in self.servers:
+                self.handles.append(server.acquire(ports))
+        except BaseException:
+            # Give back the ports already taken on the other generators
+            for handle in self.handles:
+                try:
+                    handle.release()
+                except (STLError, OSError, paramiko.SSHException):
+                    pass
+            self.pool.shutdown()
+            raise
+        self.skew = None
+
+    def _each(self, fn):
+        return list(self.pool.map(fn, range(len(self.handles))))
+
+    def _round_trip(self, i, count=5):
+        rtts = []
+        for _ in range(count):
+            start_time = time.monotonic()
+            self.handles[i].server.stl.call('ping')
+            rtts.append(time.monotonic() - start_time)
+        return min(rtts)
+
+    def start(self, profile, mult='100pps', duration=-1, **tunables):
+        per_generator = [dict(tunables) for _ in self.handles]
+        if 'flows' in tunables:
+            for tun, share in zip(per_generator, self.shares):
+                tun['flows'] = max(1, int(round(int(tunables['flows']) * share)))
+        if 'src' in tunables:
+            for tun, src in zip(per_generator, _split_ip_range(tunables['src'], self.shares)):
+                tun['src'] = src
+        self._each(lambda i: self.handles[i].load(profile, **per_generator[i]))
+        rtts = self._each(self._round_trip)
+
+        # Send the start requests so they arrive at the same time, half a round trip after they are sent
+        start_at = time.monotonic() + 0.1 + max(rtts)
+        def start_one(i):
+            delay = start_at - rtts[i] / 2 - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            sent = time.monotonic()
+            self.handles[i].start(None, mult=_split_mult(mult, self.shares[i]), duration=duration)
+            received = time.monotonic()
+            # Estimated start time on the generator
+            return sent + min(rtts[i], received - sent) / 2
+        started = self._each(start_one)
+        self.skew = max(started) - min(started)
+        if self.skew > self.max_skew:
+            self.stop()
+            raise STLError("Start skew of %.1f ms between the traffic generators is above %.1f ms" %
+                           (self.skew * 1000, self.max_skew * 1000))
+        print("Traffic started on %d generators, skew %.1f ms" % (len(self.handles), self.skew * 1000))
+        return self.skew
+
+    def stop(self):
+        self._each(lambda i: self.handles[i].stop())
+
+    def update(self, mult):
+        self._each(lambda i: self.handles[i].update(_split_mult(mult, self.shares[i])))
+
+    def clear_stats(self):
+        self._each(lambda i: self.handles[i].clear_stats())
+
+    # One view of the fleet: 'global' and 'total' are the sums over all generators, and 'generators'
+    # holds the stats of each generator by endpoint
+    def get_stats(self):
+        stats = self._each(lambda i: self.handles[i].get_stats())
+        return {'global': _merge_counters([s.get('global', {}) for s in stats]),
+                'total': _merge_counters([s.get('total', {}) for s in stats]),
+                'generators': dict(zip(self.endpoints, stats))}
+
+    def release(self):
+        self._each(lambda i: self.handles[i].release())
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+RFC2544_FRAME_SIZES = [64, 128, 256, 512, 1024, 1280, 1518]
+# First pg_id of the flow stats that count the packets of a trial
+RFC2544_PG_ID = 200
+
+# Image versions of the emulator release under test, from image_version.py
+def _image_release():
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('image_version', IMAGE_VERSION_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return {'release': module.ConfigS1SdkVer_sonic, 'sdk': module.ConfigS1SdkVer_sonic,
+            'npsuite': module.ConfigS1NpsuiteVer_sonic}
+
+# Sends traffic from tx to rx at pps packets per second for duration seconds, returns (sent, received)
+# profile is the path of the profile on the server, from TRexPorts.upload()
+# The packets of the trial are counted by the flow stats of its streams, one pg_id per DSCP value,
+# since the port counters also count the OSPF and LDP packets of the routers
+def _rfc2544_trial(tx, rx, profile, frame_size, pps, duration, settle, tunables):
+    dscps = tunables.get('dscp', [0])
+    if not isinstance(dscps, (list, tuple)):
+        dscps = str(dscps).split(':')
+    pg_ids = [RFC2544_PG_ID + i for i in range(len(dscps))]
+    tx.clear_stats()
+    rx.clear_stats()
+    tx.server.stl.start(profile, ports=tx.ports, mult='%dpps' % pps, duration=duration, size=frame_size,
+                        stats_pg_id=RFC2544_PG_ID, **tunables)
+    while tx.server.stl.is_traffic_active(ports=tx.ports):
+        time.sleep(0.2)
+    # Wait for the packets still in flight through the routers
+    time.sleep(settle)
+    flow_stats = tx.get_pgid_stats(pg_ids).get('flow_stats', {})
+    sent = sum(flow_stats.get(pg_id, {}).get('tx_pkts', {}).get('total', 0) for pg_id in pg_ids)
+    received = sum(flow_stats.get(pg_id, {}).get('rx_pkts', {}).get('total', 0) for pg_id in pg_ids)
+    return sent, received
+
+# The below function measures the RFC 2544 throughput through the simulated network, for each frame size:
+# the highest rate, up to max_pps, at which the loss is at most loss_tolerance (a fraction of the packets
+# sent). The rate is found by a binary search that stops when it is known within precision (a fraction
+# of the rate). Traffic is sent on tx_port by the profile and received on rx_port, and only the packets
+# of the profile are counted: it must take a stats_pg_id tunable like traffic_flows.py.
+# The other tunables are passed to the profile, except size and stats_pg_id, which each trial sets.
+# One row per frame size is appended to results_file (CSV), with the image versions of image_version.py
+# so the results of several releases can be compared. Returns the rows.
+def rfc2544_throughput(trexipaddress, trexport, frame_sizes=RFC2544_FRAME_SIZES, max_pps=10000, precision=0.01,
+                       loss_tolerance=0.0, trial_duration=10, settle=2, tx_port=0, rx_port=1,
+                       profile=None, results_file='rfc2544_results.csv', **tunables):
+    import csv
+    reserved = sorted(set(tunables) & {'size', 'stats_pg_id'})
+    if reserved:
+        raise ValueError("Each trial sets the size and stats_pg_id tunables (use frame_sizes for the sizes), got %s" % reserved)
+    if profile is None:
+        profile = os.path.join(STL_HELPERS_DIR, 'traffic_flows.py')
+    release = _image_release()
+    server = get_trex_server(trexipaddress, trexport)
+    rows = []
+    with server.acquire([tx_port]) as tx, server.acquire([rx_port]) as rx:
+        profile = tx.upload(profile)
+        for frame_size in frame_sizes:
+            start_time = time.time()
+            trials = 0
+            best = (0, None)
+            low, high, rate = 0, max_pps, max_pps
+            while True:
+                sent, received = _rfc2544_trial(tx, rx, profile, frame_size, rate, trial_duration, settle, tunables)
+                trials += 1
+                loss = float(sent - received) / sent if sent else 1.0
+                print("%5d bytes %10d pps: sent %d, received %d, loss %.4f%%" % (frame_size, rate, sent, received, loss * 100))
+                if loss <= loss_tolerance:
+                    low, best = rate, (rate, loss)
+                else:
+                    high = rate
+                if high - low <= max(1, precision * high):
+                    break
+                rate = (low + high) // 2
+            throughput, loss = best
+            row = dict(release)
+            row.update({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'frame_size': frame_size,
+                        'throughput_pps': throughput, 'throughput_mbps': round(throughput * frame_size * 8 / 1e6, 3),
+                        'loss_percent': None if loss is None else round(loss * 100, 4), 'max_pps': max_pps,
+                        'precision': precision, 'loss_tolerance': loss_tolerance, 'trials': trials,
+                        'seconds': round(time.time() - start_time, 1)})
+            rows.append(row)
+
+    if results_file and rows:
+        new_file = not os.path.exists(results_file)
+        with open(results_file, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+        print("Results appended to", results_file)
+    print("\nFrame size  Throughput (pps)  Throughput (Mbps)")
+    for row in rows:
+        print("%10d  %16d  %17.3f" % (row['frame_size'], row['throughput_pps'], row['throughput_mbps']))
+    return rows
+
 
 # The below function sends bidirectional traffic. 
 # TREX is in stateful mode.
@@ -16,7 +1005,6 @@ def generate_bidir_traffic(trexipaddress, trexport):
     import logging
     logging.basicConfig()
     logging.getLogger("paramiko").setLevel(logging.ERROR)
-    from paramiko_expect import SSHClientInteraction
     PROMPT = '.*root.*'
     TREX_PROMPT = '.*trex.*'
     client = paramiko.SSHClient()
@@ -26,13 +1014,11 @@ def generate_bidir_traffic(trexipaddress, trexport):
     client.connect(hostname=trexipaddress, port=trexport, username='root', password='cisco123')
 
     # SFTP for file transfer
-    transfer = client.open_sftp()
-    transfer.put("traffic/trex_cfg.yaml", "/etc/trex_cfg.yaml")
-    transfer.put("traffic/test-new.yaml", "/opt/cisco/trex/latest/cap2/test-new.yaml")
-    transfer.close() 
+    put_files(client, [("traffic/trex_cfg.yaml", "/etc/trex_cfg.yaml"),
+                       ("traffic/test-new.yaml", "/opt/cisco/trex/latest/cap2/test-new.yaml")])
 
     # Interact mode to perform the configurations for the traffic
-    interact = SSHClientInteraction(client, timeout=30, display=True)
+    interact = ExpectSession(client, timeout=30, display=True)
     interact.expect(PROMPT)
 
     #interact.send('ifconfig eth1 up; ifconfig eth2 up')
@@ -43,7 +1029,8 @@ def generate_bidir_traffic(trexipaddress, trexport):
 
     # Start traffic for 1 second. Change the -d value to send traffic for longer.
     interact.send('./t-rex-64 -f cap2/test-new.yaml -m 300 -d 1')
-    interact.expect('.*')
+    # Wait for the run to end and the shell prompt to come back
+    interact.expect(PROMPT, timeout=120)
   
     interact.send('exit')
     interact.expect()
@@ -53,9 +1040,8 @@ def generate_bidir_traffic(trexipaddress, trexport):
 
 # The below function sends unidirectional high-priority traffic. 
 # TREX is in stateless mode
-def generate_hipriority_traffic (trexipaddress, trexport):
+def generate_hipriority_traffic (trexipaddress, trexport, api=False):
     import paramiko
-    from paramiko_expect import SSHClientInteraction
     PROMPT = '.*root.*'
     TREX_PROMPT = '.*trex.*'
     # Connecting to the first SSH console to start the TREX server
@@ -65,58 +1051,70 @@ def generate_hipriority_traffic (trexipaddress, trexport):
     client1.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     client1.connect(hostname=trexipaddress, port=trexport, username='root', password='cisco123')
     
-    # SFTP for file transfer
-    transfer = client1.open_sftp()
-    transfer.put("traffic/trex_cfg.yaml", "/etc/trex_cfg.yaml")
-    transfer.put("traffic/dscp_traffic1.py", "/opt/cisco/trex/latest/stl/dscp_traffic1.py")
-    transfer.close() 
+    client2 = interact1 = interact2 = None
+    try:
+        # SFTP for file transfer
+        put_files(client1, [("traffic/trex_cfg.yaml", "/etc/trex_cfg.yaml"),
+                            ("traffic/dscp_traffic1.py", "/opt/cisco/trex/latest/stl/dscp_traffic1.py"),
+                            ("traffic/pkt_cache.py", "/opt/cisco/trex/latest/stl/pkt_cache.py"),
+                            ("traffic/size_mix.py", "/opt/cisco/trex/latest/stl/size_mix.py")])
     
-    # Interact mode to perform the configurations for the traffic
-    interact1 = SSHClientInteraction(client1, timeout=30, display=True)
-    interact1.expect(PROMPT)
+        # Interact mode to perform the configurations for the traffic
+        interact1 = ExpectSession(client1, timeout=30, display=True)
+        interact1.expect(PROMPT)
     
-#    interact1.send('yum -y install net-tools')
-#    interact1.expect(PROMPT, timeout=500)
+#        interact1.send('yum -y install net-tools')
+#        interact1.expect(PROMPT, timeout=500)
     
-#    interact1.send('yum -y install pciutils')
-#    interact1.expect(PROMPT, timeout=500)
+#        interact1.send('yum -y install pciutils')
+#        interact1.expect(PROMPT, timeout=500)
     
-    interact1.send('ifconfig eth1 10.0.0.1 netmask 255.255.255.0 up; ifconfig eth2 10.1.1.1 netmask 255.255.255.0 up')
-    interact1.expect(PROMPT)
+        interact1.send('ifconfig eth1 10.0.0.1 netmask 255.255.255.0 up; ifconfig eth2 10.1.1.1 netmask 255.255.255.0 up')
+        interact1.expect(PROMPT)
 
-    interact1.send('cd /opt/cisco/trex/latest/')
-    interact1.expect(PROMPT)
+        interact1.send('cd /opt/cisco/trex/latest/')
+        interact1.expect(PROMPT)
     
-    interact1.send('./t-rex-64 -i')
-    interact1.expect('.*wait 1 sec.*', timeout=120)
+        interact1.send('./t-rex-64 -i')
+        interact1.expect('.*wait 1 sec.*', timeout=120)
     
-    # Connecting to the first SSH console to send traffic
-    client2 = paramiko.SSHClient()
-    # Set SSH key parameters to auto accept unknown hosts
-    client2.load_system_host_keys()
-    client2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client2.connect(hostname=trexipaddress, port=trexport, username='root', password='cisco123')
+        # With api=True the traffic is started through the STL Python API instead of trex-console,
+        # and the STLSession is returned in place of client2
+        if api:
+            client2 = STLSession(client1)
+            client2.start('stl/dscp_traffic1.py', ports=[0], mult='100pps', duration=3600)
+            return client1, client2, interact1, None
+
+        # Connecting to the first SSH console to send traffic
+        client2 = paramiko.SSHClient()
+        # Set SSH key parameters to auto accept unknown hosts
+        client2.load_system_host_keys()
+        client2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client2.connect(hostname=trexipaddress, port=trexport, username='root', password='cisco123')
                     
-    # Interact mode to perform the configurations for the traffic
-    interact2 = SSHClientInteraction(client2, timeout=100, display=True)
-    interact2.expect(PROMPT)
+        # Interact mode to perform the configurations for the traffic
+        interact2 = ExpectSession(client2, timeout=100, display=True)
+        interact2.expect(PROMPT)
 
-    interact2.send('cd /opt/cisco/trex/latest/')
-    interact2.expect(PROMPT)
+        interact2.send('cd /opt/cisco/trex/latest/')
+        interact2.expect(PROMPT)
                     
-    interact2.send('./trex-console')
-    interact2.expect('.*trex.*', timeout=120)
+        interact2.send('./trex-console')
+        interact2.expect('.*trex.*', timeout=120)
     
-    interact2.send('start -f stl/dscp_traffic1.py -d 1h -m 100pps -p 0')
-    interact2.expect('.*trex.*', timeout=120)
+        interact2.send('start -f stl/dscp_traffic1.py -d 1h -m 100pps -p 0')
+        interact2.expect('.*trex.*', timeout=120)
     
-    return client1, client2, interact1, interact2
+        return client1, client2, interact1, interact2
+    except BaseException:
+        # Nothing is left running on the traffic generator when the start fails part-way
+        stop_traffic(client1, client2, interact1, interact2)
+        raise
 
 # The below function sends 3 streams of unidirectional traffic. 
 # TREX is in stateless mode
-def generate_3traffic_streams (trexipaddress, trexport):
+def generate_3traffic_streams (trexipaddress, trexport, api=False):
     import paramiko
-    from paramiko_expect import SSHClientInteraction
     PROMPT = '.*root.*'
     TREX_PROMPT = '.*trex.*'
     # Connecting to the first SSH console to start the TREX server
@@ -126,52 +1124,122 @@ def generate_3traffic_streams (trexipaddress, trexport):
     client1.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     client1.connect(hostname=trexipaddress, port=trexport, username='root', password='cisco123')
     
-    # SFTP for file transfer
-    transfer = client1.open_sftp()
-    transfer.put("traffic/trex_cfg.yaml", "/etc/trex_cfg.yaml")
-    transfer.put("traffic/traffic_3st.py", "/opt/cisco/trex/latest/stl/traffic_3st.py")
-    transfer.close() 
+    client2 = interact1 = interact2 = None
+    try:
+        # SFTP for file transfer
+        put_files(client1, [("traffic/trex_cfg.yaml", "/etc/trex_cfg.yaml"),
+                            ("traffic/traffic_3st.py", "/opt/cisco/trex/latest/stl/traffic_3st.py"),
+                            ("traffic/pkt_cache.py", "/opt/cisco/trex/latest/stl/pkt_cache.py"),
+                            ("traffic/size_mix.py", "/opt/cisco/trex/latest/stl/size_mix.py")])
     
-    # Interact mode to perform the configurations for the traffic
-    interact1 = SSHClientInteraction(client1, timeout=30, display=True)
-    interact1.expect(PROMPT)
+        # Interact mode to perform the configurations for the traffic
+        interact1 = ExpectSession(client1, timeout=30, display=True)
+        interact1.expect(PROMPT)
     
-    #interact1.send('sudo yum install net-tools')
-    #interact1.expect(PROMPT)
+        #interact1.send('sudo yum install net-tools')
+        #interact1.expect(PROMPT)
     
-    #interact1.send('sudo yum install pciutils')
-    #interact1.expect(PROMPT)
+        #interact1.send('sudo yum install pciutils')
+        #interact1.expect(PROMPT)
 
-    interact1.send('ifconfig eth1 10.0.5.2 netmask 255.255.255.0 up; ifconfig eth2 10.0.6.2 netmask 255.255.255.0 up')
-    interact1.expect(PROMPT)
+        interact1.send('ifconfig eth1 10.0.5.2 netmask 255.255.255.0 up; ifconfig eth2 10.0.6.2 netmask 255.255.255.0 up')
+        interact1.expect(PROMPT)
 
-    interact1.send('cd /opt/cisco/trex/latest/')
-    interact1.expect(PROMPT)
+        interact1.send('cd /opt/cisco/trex/latest/')
+        interact1.expect(PROMPT)
     
-    interact1.send('./t-rex-64 -i')
-    interact1.expect('.*wait 1 sec.*', timeout=120)
+        interact1.send('./t-rex-64 -i')
+        interact1.expect('.*wait 1 sec.*', timeout=120)
     
-    # Connecting to the first SSH console to send traffic
-    client2 = paramiko.SSHClient()
-    # Set SSH key parameters to auto accept unknown hosts
-    client2.load_system_host_keys()
-    client2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client2.connect(hostname=trexipaddress, port=trexport, username='root', password='cisco123')
+        # With api=True the traffic is started through the STL Python API instead of trex-console,
+        # and the STLSession is returned in place of client2
+        if api:
+            client2 = STLSession(client1)
+            client2.start('stl/traffic_3st.py', ports=[0], mult='100pps', duration=3600)
+            return client1, client2, interact1, None
+
+        # Connecting to the first SSH console to send traffic
+        client2 = paramiko.SSHClient()
+        # Set SSH key parameters to auto accept unknown hosts
+        client2.load_system_host_keys()
+        client2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client2.connect(hostname=trexipaddress, port=trexport, username='root', password='cisco123')
                     
-    # Interact mode to perform the configurations for the traffic
-    interact2 = SSHClientInteraction(client2, timeout=30, display=True)
-    interact2.expect(PROMPT)
+        # Interact mode to perform the configurations for the traffic
+        interact2 = ExpectSession(client2, timeout=30, display=True)
+        interact2.expect(PROMPT)
 
-    interact2.send('cd /opt/cisco/trex/latest/')
-    interact2.expect(PROMPT)
+        interact2.send('cd /opt/cisco/trex/latest/')
+        interact2.expect(PROMPT)
                     
-    interact2.send('./trex-console')
-    interact2.expect('.*trex.*', timeout=60)
+        interact2.send('./trex-console')
+        interact2.expect('.*trex.*', timeout=60)
     
-    interact2.send('start -f stl/traffic_3st.py -d 1h -m 100pps -p 0')
-    interact2.expect('.*trex.*', timeout=60)
+        interact2.send('start -f stl/traffic_3st.py -d 1h -m 100pps -p 0')
+        interact2.expect('.*trex.*', timeout=60)
     
-    return client1, client2, interact1, interact2
+        return client1, client2, interact1, interact2
+    except BaseException:
+        # Nothing is left running on the traffic generator when the start fails part-way
+        stop_traffic(client1, client2, interact1, interact2)
+        raise
+
+# The below function stops the traffic and ends the sessions. 
+# Stateless mode
+# The TREX server is stopped and the data ports are given back to the kernel with a single script,
+# run by access_handle (the pyATS device of the traffic generator) or else over client1.
+# Every handle is closed even if stopping the traffic fails.
+def stop_traffic (client1, client2, interact1, interact2, access_handle=None):
+    start_time = time.time()
+    try:
+        if isinstance(client2, STLSession):
+            client2.stop()
+        elif interact2 is not None:
+            interact2.send('stop -a')
+            interact2.expect('.*trex.*', timeout=5)
+    except (STLError, OSError, EOFError, paramiko.SSHException) as e:
+        print("Stopping the traffic failed:", e)
+    finally:
+        for handle in (interact2, client2, interact1):
+            if handle is not None:
+                try:
+                    handle.close()
+                except (STLError, OSError, paramiko.SSHException):
+                    pass
+        try:
+            if access_handle is not None:
+                access_handle.execute(trex_teardown_script())
+            else:
+                stdin, stdout, stderr = client1.exec_command(trex_teardown_script(), timeout=60)
+                stdout.channel.recv_exit_status()
+        finally:
+            client1.close()
+            print("Traffic teardown done in %.1f sec" % (time.time() - start_time))
+
+# Traffic run that is always torn down, also when a cell fails:
+#     with TrafficSession(generate_hipriority_traffic, trex_ipaddress, trex_port, nodes['trex']) as (client1, client2, interact1, interact2):
+#         ...
+# generate is one of the stateless generate_* functions, called with kwargs (e.g. api=True).
+# If generate fails part-way, it tears down what it started itself before raising.
+# The teardown time is kept in teardown_seconds.
+class TrafficSession(object):
+
+    def __init__(self, generate, trexipaddress, trexport, access_handle=None, **kwargs):
+        self.generate = generate
+        self.args = (trexipaddress, trexport)
+        self.kwargs = kwargs
+        self.access_handle = access_handle
+        self.handles = None
+        self.teardown_seconds = None
+
+    def __enter__(self):
+        self.handles = self.generate(*self.args, **self.kwargs)
+        return self.handles
+
+    def __exit__(self, *exc):
+        start_time = time.time()
+        stop_traffic(*self.handles, access_handle=self.access_handle)
+        self.teardown_seconds = time.time() - start_time
 
 
 # Overriding the get_ssh_cmd function for accessing the traffic generator server
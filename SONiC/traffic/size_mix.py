@@ -0,0 +1,80 @@
+from trex_stl_lib.api import *
+from math import gcd
+from functools import reduce
+
+# Weighted packet size distributions for the profiles, copied next to them in the stl/ directory of the TREX server.
+# A mix is a list of (frame size including the FCS, weight). It is sent by a single stream: a Field Engine
+# variable walks through a list of sizes in which every size appears as often as its weight, spread out
+# evenly, and the packet is cut to that size.
+#
+# A size tunable can be:
+#   a single frame size        -- 64
+#   a preset                   -- imix or tolly, see SIZE_MIX_PRESETS
+#   a user-defined mix         -- "64*7:594*4:1518*1" (size*weight separated by ':'), or from Python
+#                                 a dict {64: 7, 594: 4, 1518: 1} or a list of (size, weight)
+SIZE_MIX_PRESETS = {
+    # Simple IMIX, 7:4:1
+    'imix': [(64, 7), (594, 4), (1518, 1)],
+    # Tolly IMIX
+    'tolly': [(64, 55), (78, 5), (576, 17), (1518, 23)],
+}
+
+# Longest list of sizes in the Field Engine variable, the weights are scaled down to fit
+MAX_SIZE_LIST = 1000
+
+
+def parse_size_mix(value):
+    if isinstance(value, dict):
+        mix = [(int(size), int(weight)) for size, weight in value.items()]
+    elif isinstance(value, (list, tuple)):
+        mix = [(int(size), int(weight)) for size, weight in value]
+    elif str(value).lower() in SIZE_MIX_PRESETS:
+        mix = SIZE_MIX_PRESETS[str(value).lower()]
+    else:
+        mix = []
+        for item in str(value).split(':'):
+            size, _, weight = item.partition('*')
+            mix.append((int(size), int(weight or 1)))
+    mix = [(size, weight) for size, weight in mix if weight > 0]
+    if not mix:
+        raise ValueError("Empty packet size mix: %r" % (value,))
+    return mix
+
+
+def average_size(mix):
+    return float(sum(size * weight for size, weight in mix)) / sum(weight for size, weight in mix)
+
+
+def _size_list(mix):
+    divisor = reduce(gcd, [weight for size, weight in mix])
+    weights = [weight // divisor for size, weight in mix]
+    if sum(weights) > MAX_SIZE_LIST:
+        scale = float(MAX_SIZE_LIST) / sum(weights)
+        weights = [max(1, int(round(w * scale))) for w in weights]
+    # Smooth weighted round robin, so that the sizes are interleaved instead of sent in bursts
+    current = [0] * len(mix)
+    sizes = []
+    for _ in range(sum(weights)):
+        for i, w in enumerate(weights):
+            current[i] += w
+        i = current.index(max(current))
+        current[i] -= sum(weights)
+        sizes.append(mix[i][0])
+    return sizes
+
+
+def size_mix_vm(mix):
+    """Return (largest packet size, Field Engine instructions) to send the packet sizes of mix.
+
+    The sizes are without the 4 bytes of the ethernet FCS. The base packet must be padded to the
+    largest size and be Ether()/IP()/UDP(chksum=0), since the trimmed packets would otherwise keep
+    the UDP checksum of the full-size packet. The instructions fix the IP and UDP lengths; the
+    profile must add STLVmFixIpv4 after them. A single size needs no instructions.
+    """
+    sizes = [size - 4 for size in _size_list(mix)]
+    if len(set(sizes)) == 1:
+        return sizes[0], []
+    return max(sizes), [STLVmFlowVar(name='fsize', value_list=sizes, size=2, op='inc'),
+                        STLVmTrimPktSize('fsize'),
+                        STLVmWrFlowVar(fv_name='fsize', pkt_offset='IP.len', add_val=-14),
+                        STLVmWrFlowVar(fv_name='fsize', pkt_offset='UDP.len', add_val=-34)]
@@ -0,0 +1,136 @@
+# DESCRIPTION: Small agent that runs on the TREX server and drives it through the TREX STL Python API.
+# TrafficGenerator.STLSession copies it to /opt/cisco/trex/latest/ and starts it over SSH.
+# It reads one JSON request per line on stdin, e.g.
+#     {"id": 1, "cmd": "start", "args": {"profile": "stl/dscp_traffic1.py", "ports": [0], "mult": "100pps"}}
+# and writes one JSON reply per line on stdout:
+#     {"id": 1, "result": ...}  or  {"id": 1, "error": "..."}
+# The STL API talks to the RPC port of the local TREX server (4501 by default). Use --server and
+# --sync-port to point it at another server, e.g. a local stub RPC server. fake_stl.py runs this agent
+# on a fake STL API, to try the protocol without TREX.
+# PLATFORM: Emulator for CISCO 8000
+
+import argparse
+import json
+import os
+import sys
+import traceback
+
+TREX_DIR = os.path.dirname(os.path.abspath(__file__))
+# Newer TREX releases ship the STL API in interactive/, older ones in stl/
+for path in ('automation/trex_control_plane/stl', 'automation/trex_control_plane/interactive'):
+    sys.path.insert(0, os.path.join(TREX_DIR, path))
+
+from trex_stl_lib.api import STLClient, STLProfile
+
+
+class Agent(object):
+
+    def __init__(self, server, sync_port, async_port):
+        self.client = STLClient(server=server, sync_port=sync_port, async_port=async_port)
+        self.connected = False
+
+    def connect(self):
+        self.client.connect()
+        self.connected = True
+        return self.client.get_server_version()
+
+    def acquire(self, ports, force=False):
+        self.client.acquire(ports=ports, force=force)
+        return ports
+
+    def release(self, ports):
+        self.client.release(ports=ports)
+        return ports
+
+    def load(self, profile, ports, tunables=None):
+        # The streams of each port are loaded with the direction of the port, like trex-console does
+        self.client.reset(ports=ports)
+        for port in ports:
+            streams = STLProfile.load(profile, direction=port % 2, port_id=port, **(tunables or {})).get_streams()
+            self.client.add_streams(streams, ports=[port])
+        return ports
+
+    def start(self, profile, ports, mult='1', duration=-1, force=True, tunables=None):
+        # Same as 'start -f profile -m mult -d duration -p ports' in trex-console.
+        # Without a profile, the streams of the last load() are started.
+        if profile is not None:
+            self.load(profile, ports, tunables)
+        self.client.start(ports=ports, mult=mult, duration=duration, force=force)
+        return ports
+
+    def stop(self, ports=None):
+        self.client.stop(ports=ports)
+        return ports
+
+    def update(self, mult, ports=None):
+        self.client.update(ports=ports, mult=mult)
+        return mult
+
+    def stats(self, ports=None):
+        return self.client.get_stats(ports=ports)
+
+    # Per-stream counters and latency of the streams with flow_stats, by pg_id
+    def pgid_stats(self, pg_ids=None):
+        if hasattr(self.client, 'get_pgid_stats'):
+            return self.client.get_pgid_stats(pg_ids)
+        # Older releases only report them in get_stats()
+        stats = self.client.get_stats()
+        return {'latency': stats.get('latency', {}), 'flow_stats': stats.get('flow_stats', {})}
+
+    def clear_stats(self, ports=None):
+        self.client.clear_stats(ports=ports)
+        return ports
+
+    def is_traffic_active(self, ports=None):
+        return self.client.is_traffic_active(ports=ports)
+
+    def version(self):
+        return self.client.get_server_version()
+
+    def ping(self):
+        return os.getpid()
+
+    def disconnect(self):
+        self.client.disconnect()
+        self.connected = False
+        return True
+
+    COMMANDS = ('connect', 'acquire', 'release', 'load', 'start', 'stop', 'update', 'stats', 'pgid_stats', 'clear_stats',
+                'is_traffic_active', 'version', 'ping', 'disconnect')
+
+    def serve(self, requests, replies):
+        try:
+            for line in requests:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    if request['cmd'] not in self.COMMANDS:
+                        raise ValueError("Unknown command: %r" % (request['cmd'],))
+                    reply = {'result': getattr(self, request['cmd'])(**request.get('args', {}))}
+                except Exception as e:
+                    traceback.print_exc()
+                    reply = {'error': '%s: %s' % (type(e).__name__, e)}
+                reply['id'] = request.get('id')
+                replies.write(json.dumps(reply, default=str) + '\n')
+                replies.flush()
+                if request['cmd'] == 'disconnect':
+                    return
+        finally:
+            # stdin was closed without a disconnect, e.g. the notebook kernel died: stop the traffic and
+            # release the ports, which the TREX server would otherwise keep for this dead session
+            if self.connected:
+                self.client.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Drive the TREX server through the STL Python API")
+    parser.add_argument('--server', default='127.0.0.1')
+    parser.add_argument('--sync-port', type=int, default=4501)
+    parser.add_argument('--async-port', type=int, default=4500)
+    args = parser.parse_args()
+    os.chdir(TREX_DIR)
+    # The STL API prints messages on stdout, which carries the replies: send them to stderr instead
+    replies = sys.stdout
+    sys.stdout = sys.stderr
+    Agent(args.server, args.sync_port, args.async_port).serve(sys.stdin, replies)
@@ -1,42 +1,68 @@
 from trex_stl_lib.api import *
+from pkt_cache import cached_pkt
+from size_mix import parse_size_mix, size_mix_vm
 
 class STLS1(object):
 
     def __init__ (self):
-        self.fsize  =64; # the size of the packet 
+        self.fsize  =64; # the size of the packet, or a mix of sizes (see size_mix.py)
+        self.latency_pps  =10; # the rate of each latency-tagged stream
 
 
-    def create_stream (self):
+    # The fields of the base packet of each stream: (src, dst, tos, sport, dport)
+    pkt_fields = [
+        ('10.0.5.2', '10.0.6.2', 0, 1025, 12),
+        ('10.0.5.3', '10.0.6.2', 0, 1025, 12),
+        ('10.0.5.4', '10.0.6.2', 0, 1025, 12),
+    ]
 
-        # Create base packet and pad it to size
-        size = self.fsize - 4; # HW will add 4 bytes ethernet FCS
-        base_pkt =  Ether()/IP(src="10.0.5.2",dst="10.0.6.2")/UDP(dport=12,sport=1025)
-        base_pkt1 =  Ether()/IP(src="10.0.5.3",dst="10.0.6.2")/UDP(dport=12,sport=1025)
-        base_pkt2 =  Ether()/IP(src="10.0.5.4",dst="10.0.6.2")/UDP(dport=12,sport=1025)
-        pad = max(0, size - len(base_pkt)) * 'x'
+    def create_pkt_base (self, src, dst, tos, sport, dport):
+        # The UDP checksum is disabled (0) because the Field Engine trims the packets it covers
+        return Ether()/IP(src=src,dst=dst,tos=tos)/UDP(dport=dport,sport=sport,chksum=0)
 
 
-        return STLProfile( [ STLStream( isg = 1.0, # start in delay in usec 
-                                        packet = STLPktBuilder(pkt = base_pkt/pad),
-                                        mode = STLTXCont( pps = 10),
-                                        ), 
+    def create_pkts (self, size):
+        # Create base packets padded to size, built once for each of their fields by pkt_cache
+        return [ cached_pkt(('traffic_3st',) + fields, size, lambda: self.create_pkt_base(*fields))
+                 for fields in self.pkt_fields ]
 
-                             STLStream( isg = 2.0,
-                                        packet  = STLPktBuilder(pkt = base_pkt1/pad),
-                                        mode    = STLTXCont( pps = 20),
-                                        ),
 
-                             STLStream(  isg = 3.0,
-                                         packet = STLPktBuilder(pkt = base_pkt2/pad),
-                                         mode    = STLTXCont( pps = 30)
-                                         
-                                        )
-                            ]).get_streams()
+    def create_vm (self, mix):
+        # Cut the packets to the sizes of the mix, if there are several
+        size, vm = size_mix_vm(mix) # HW will add 4 bytes ethernet FCS
+        if vm:
+            vm.append(STLVmFixIpv4(offset='IP'))
+        return size, vm
 
 
-    def get_streams (self, direction = 0, **kwargs):
-        # create 1 stream 
-        return self.create_stream() 
+    def create_stream (self, pg_id = None, size = None):
+
+        mix = parse_size_mix(size or self.fsize)
+        # One Field Engine program per stream, built once
+        vms = [self.create_vm(mix) for i in range(3)]
+        size = vms[0][0]
+        streams = []
+        for pkt, (_, vm), isg, pps in zip(self.create_pkts(size), vms, [1.0, 2.0, 3.0], [10, 20, 30]):
+            streams.append(STLStream( isg = isg, # start in delay in usec
+                                      packet = STLPktBuilder(pkt_buffer = pkt, vm = vm),
+                                      mode = STLTXCont( pps = pps)))
+        return STLProfile(streams + self.create_latency_streams(min(s for s, w in mix) - 4, pg_id)).get_streams()
+
+
+    def create_latency_streams (self, size, pg_id):
+        # With a pg_id, a latency-tagged copy of each stream is added, with pg_id, pg_id + 1 and pg_id + 2.
+        # They all use the smallest size of the mix.
+        if pg_id is None:
+            return []
+        return [ STLStream( packet = STLPktBuilder(pkt_buffer = pkt),
+                            mode = STLTXCont( pps = self.latency_pps),
+                            flow_stats = STLFlowLatencyStats(pg_id = int(pg_id) + i))
+                 for i, pkt in enumerate(self.create_pkts(size)) ]
+
+
+    def get_streams (self, direction = 0, pg_id = None, size = None, **kwargs):
+        # create 3 streams, and 3 latency-tagged streams if pg_id is given
+        return self.create_stream(pg_id, size) 
 
 
 # dynamic load - used for trex console or emulator
@@ -0,0 +1,125 @@
+from trex_stl_lib.api import *
+from pkt_cache import cached_pkt
+from size_mix import parse_size_mix, size_mix_vm
+
+# Parametric profile: one stream per DSCP value, with the flows generated by the Field Engine
+# on the TREX server instead of one stream per flow.
+#
+# Tunables (trex-console: start -f stl/traffic_flows.py -t flows=1000,size=64-1518):
+#   flows  -- number of (source IP, source port) pairs
+#   src    -- source IP range, e.g. 10.0.5.2-10.0.5.254
+#   dst    -- destination IP range
+#   sport  -- UDP source port range
+#   dport  -- UDP destination port range
+#   dscp   -- DSCP values, one stream each, e.g. [0, 46] or "0:46"
+#   size   -- frame size or range of frame sizes including the FCS, e.g. 64 or 64-1518 (random sizes),
+#             or a weighted mix of sizes, e.g. imix or 64*7:594*4:1518*1 (see size_mix.py)
+#   pps    -- packets per second, shared by the streams
+#   pg_id  -- if given, a latency-tagged stream of latency_pps packets per second is added for each
+#             DSCP value, with pg_id, pg_id + 1, ... in the order of dscp
+#   stats_pg_id -- if given, the packets of the stream of each DSCP value are counted by the TREX server
+#             (flow stats), with stats_pg_id, stats_pg_id + 1, ... in the order of dscp
+# Ranges are "min-max" strings or a single value. The traffic of direction 1 goes from dst to src.
+
+DEFAULTS = {
+    'flows': 100,
+    'src': '10.0.5.2-10.0.5.254',
+    'dst': '10.0.6.2',
+    'sport': '1025-65535',
+    'dport': '12',
+    'dscp': [0],
+    'size': '64',
+    'pps': 100,
+    'pg_id': None,
+    'stats_pg_id': None,
+    'latency_pps': 10,
+}
+
+
+def _range(value, parse=int):
+    value = str(value)
+    low, _, high = value.partition('-')
+    return parse(low), parse(high or low)
+
+def _sizes(value):
+    # (smallest size, largest size, Field Engine instructions) of a size tunable, without the 4 bytes of the FCS
+    if isinstance(value, str) and '-' in value:
+        min_size, max_size = [size - 4 for size in _range(value)]
+        if min_size == max_size:
+            return min_size, max_size, []
+        # Cut the packet to a random size and fix the IP and UDP lengths
+        return min_size, max_size, [STLVmFlowVar(name='size', min_value=min_size, max_value=max_size, size=2, op='random'),
+                                    STLVmTrimPktSize('size'),
+                                    STLVmWrFlowVar(fv_name='size', pkt_offset='IP.len', add_val=-14),
+                                    STLVmWrFlowVar(fv_name='size', pkt_offset='UDP.len', add_val=-34)]
+    mix = parse_size_mix(value)
+    max_size, vm = size_mix_vm(mix)
+    return min(size for size, weight in mix) - 4, max_size, vm
+
+def _list(value):
+    if isinstance(value, (list, tuple)):
+        return [int(v) for v in value]
+    return [int(v) for v in str(value).split(':')]
+
+
+class STLS1(object):
+
+    def create_stream (self, dscp, pps, flows, src, dst, sport, dport, size, stats_pg_id = None):
+        max_size, size_vm = _sizes(size)[1:]
+        # The UDP checksum is disabled (0) because the Field Engine changes the fields it covers
+        base_pkt = cached_pkt(('traffic_flows', src[0], dst[0], dscp, sport[0], dport[0]), max_size,
+                              lambda: Ether()/IP(src=src[0], dst=dst[0], tos=dscp << 2)/UDP(sport=sport[0], dport=dport[0], chksum=0))
+
+        vm = []
+        if src[0] != src[1] or sport[0] != sport[1]:
+            # Every flow is a unique (source IP, source port) pair
+            vm += [STLVmTupleGen(ip_min=src[0], ip_max=src[1], port_min=sport[0], port_max=sport[1],
+                                 name='tuple', limit_flows=flows),
+                   STLVmWrFlowVar(fv_name='tuple.ip', pkt_offset='IP.src'),
+                   STLVmWrFlowVar(fv_name='tuple.port', pkt_offset='UDP.sport')]
+        if dst[0] != dst[1]:
+            vm += [STLVmFlowVar(name='dst', min_value=dst[0], max_value=dst[1], size=4, op='inc'),
+                   STLVmWrFlowVar(fv_name='dst', pkt_offset='IP.dst')]
+        if dport[0] != dport[1]:
+            vm += [STLVmFlowVar(name='dport', min_value=dport[0], max_value=dport[1], size=2, op='inc'),
+                   STLVmWrFlowVar(fv_name='dport', pkt_offset='UDP.dport')]
+        vm += size_vm
+        if vm:
+            vm.append(STLVmFixIpv4(offset='IP'))
+
+        return STLStream(packet = STLPktBuilder(pkt_buffer = base_pkt, vm = vm),
+                         mode = STLTXCont(pps = pps),
+                         flow_stats = None if stats_pg_id is None else STLFlowStats(pg_id = stats_pg_id))
+
+
+    def create_latency_stream (self, dscp, pps, src, dst, sport, dport, size, pg_id):
+        # Fixed flow and smallest size, which the latency measurement does not need to vary
+        base_pkt = cached_pkt(('traffic_flows', src[0], dst[0], dscp, sport[0], dport[0]), _sizes(size)[0],
+                              lambda: Ether()/IP(src=src[0], dst=dst[0], tos=dscp << 2)/UDP(sport=sport[0], dport=dport[0], chksum=0))
+        return STLStream(packet = STLPktBuilder(pkt_buffer = base_pkt),
+                         mode = STLTXCont(pps = pps),
+                         flow_stats = STLFlowLatencyStats(pg_id = pg_id))
+
+
+    def get_streams (self, direction = 0, **kwargs):
+        params = dict(DEFAULTS)
+        params.update(kwargs)
+        src, dst = _range(params['src'], str), _range(params['dst'], str)
+        if direction:
+            src, dst = dst, src
+        sport, dport, size = _range(params['sport']), _range(params['dport']), params['size']
+        dscps = _list(params['dscp'])
+        stats_pg_id = params['stats_pg_id']
+        streams = [self.create_stream(dscp, float(params['pps']) / len(dscps), int(params['flows']), src, dst,
+                                      sport, dport, size, None if stats_pg_id is None else int(stats_pg_id) + i)
+                   for i, dscp in enumerate(dscps)]
+        if params['pg_id'] is not None:
+            streams += [self.create_latency_stream(dscp, float(params['latency_pps']), src, dst, sport, dport, size,
+                                                   int(params['pg_id']) + i)
+                        for i, dscp in enumerate(dscps)]
+        return streams
+
+
+# dynamic load - used for trex console or emulator
+def register():
+    return STLS1()
@@ -0,0 +1,304 @@
+# Python Library with helpers for the telnet consoles of the routers in a VXR simulation
+
+import asyncio
+import re
+import threading
+
+# A console command is done when the buffer ends with a prompt, e.g.
+# RP/0/RP0/CPU0:r1#, RP/0/RP0/CPU0:r1(config-ipv4-acl)#, [root@server ~]$ or a login prompt,
+# or with the banner printed after 'exit' logs out of the console.
+CONSOLE_PROMPT = re.compile(rb'(?:[#>$]|Username:|Password:|login:|Press RETURN to get started\.?\s*) ?$')
+CONSOLE_MORE = re.compile(rb' ?--More-- ?$')
+_PAGING_ERASE = re.compile(r' ?--More-- ?|\x08+ *\x08*|\r')
+
+
+def open_console(sim, router):
+    """Open a telnet session to the serial console of a router in a VXR simulation.
+
+    Keyword arguments:
+    sim -- an instance of the Vxr object
+    router -- the router name in the simulation
+    """
+    import telnetlib
+    console_ports = sim.ports()
+    return telnetlib.Telnet(str(console_ports[router]['HostAgent']), str(console_ports[router]['serial0']))
+
+
+def console_run(console, commands, timeout=30):
+    """Run commands on a console and return the output as soon as the prompt is back.
+
+    Each line of commands is sent on its own and the next one is only sent once the
+    device prompt, including config-mode prompts, has reappeared. --More-- pages are
+    skipped automatically.
+
+    Keyword arguments:
+    console -- a telnetlib.Telnet session, e.g. from open_console()
+    commands -- a multi-line string or a list of commands
+    timeout -- seconds to wait for the prompt after each command
+    """
+    if isinstance(commands, str):
+        commands = commands.splitlines()
+    commands = [cmd.strip() for cmd in commands if cmd.strip()]
+
+    # Keep any output left over from earlier commands
+    out = console.read_very_eager()
+    for cmd in commands:
+        console.write(cmd.encode('ascii') + b'\n')
+        out += _read_until_prompt(console, cmd, timeout)
+    return _PAGING_ERASE.sub('', out.decode(errors='replace'))
+
+
+def _read_until_prompt(console, cmd, timeout):
+    out = b''
+    while True:
+        index, match, text = console.expect([CONSOLE_PROMPT, CONSOLE_MORE], timeout)
+        out += text
+        if index == 1:
+            console.write(b' ')
+        elif index == 0 and not _prompt_after_echo(out, cmd):
+            # A prompt left over from before the command, or the echo of a command ending like a prompt
+            continue
+        else:
+            # The prompt is back, or the timeout expired
+            return out
+
+
+def _prompt_after_echo(out, cmd):
+    # Long commands may be wrapped or scrolled by the console, so only the start of the echo is checked
+    echo = cmd.encode('ascii')[:16]
+    start = out.find(echo)
+    return start >= 0 and CONSOLE_PROMPT.search(out[start + len(echo):]) is not None
+
+
+# Telnet protocol bytes, see RFC 854
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+
+
+class AsyncConsole(object):
+    """A non-blocking telnet session to one console, driven by an asyncio event loop.
+
+    A reader task moves the console output into a buffer of at most max_buffered
+    bytes. When the buffer is full the task stops reading, so TCP flow control
+    slows the console down instead of the kernel memory growing.
+    Like telnetlib, every telnet option offered by the device is refused.
+
+    Keyword arguments:
+    name -- the router name, used in error messages
+    host, port -- the HostAgent and serial0 values of sim.ports()
+    """
+
+    def __init__(self, name, host, port, read_size=65536, max_buffered=1024 * 1024):
+        self.name = name
+        self.host = str(host)
+        self.port = int(port)
+        self.read_size = read_size
+        self.max_buffered = max_buffered
+        self.writer = None
+        self.buffer = bytearray()
+        self.pending = b''
+        self.eof = False
+
+    async def open(self, timeout=30):
+        reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=self.read_size)
+        self.lock = asyncio.Lock()
+        self.data_ready = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.reader_task = asyncio.ensure_future(self._reader(reader))
+        # Wake up the console and wait for its first prompt
+        async with self.lock:
+            self.writer.write(b'\n')
+            await self._read_until_prompt('', timeout)
+
+    async def close(self):
+        if self.writer is not None:
+            self.reader_task.cancel()
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+    async def _reader(self, reader):
+        while True:
+            while len(self.buffer) >= self.max_buffered:
+                self.drained.clear()
+                await self.drained.wait()
+            data = await reader.read(self.read_size)
+            if not data:
+                self.eof = True
+                self.data_ready.set()
+                return
+            self.buffer += self._decode(data)
+            self.data_ready.set()
+
+    def _take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        self.data_ready.clear()
+        self.drained.set()
+        return data
+
+    def _decode(self, data):
+        # Strip telnet commands from data and answer option negotiations
+        data = self.pending + data
+        self.pending = b''
+        out = bytearray()
+        replies = bytearray()
+        i = 0
+        while i < len(data):
+            byte = data[i]
+            if byte != IAC:
+                out.append(byte)
+                i += 1
+                continue
+            if i + 1 >= len(data):
+                self.pending = data[i:]
+                break
+            cmd = data[i + 1]
+            if cmd == IAC:
+                out.append(IAC)
+                i += 2
+            elif cmd in (DO, DONT, WILL, WONT):
+                if i + 2 >= len(data):
+                    self.pending = data[i:]
+                    break
+                if cmd == DO:
+                    replies += bytes([IAC, WONT, data[i + 2]])
+                elif cmd == WILL:
+                    replies += bytes([IAC, DONT, data[i + 2]])
+                i += 3
+            elif cmd == SB:
+                end = data.find(bytes([IAC, SE]), i + 2)
+                if end < 0:
+                    self.pending = data[i:]
+                    break
+                i = end + 2
+            else:
+                i += 2
+        if replies:
+            self.writer.write(bytes(replies))
+        return bytes(out)
+
+    async def _read_until_prompt(self, cmd, timeout):
+        out = bytearray()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            if not self.data_ready.is_set():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return bytes(out)
+                try:
+                    await asyncio.wait_for(self.data_ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return bytes(out)
+            out += self._take()
+            if self.eof:
+                raise EOFError("Console of %s was closed" % self.name)
+            tail = bytes(out[-256:])
+            if CONSOLE_MORE.search(tail):
+                self.writer.write(b' ')
+                await self.writer.drain()
+            elif CONSOLE_PROMPT.search(tail) and _prompt_after_echo(bytes(out), cmd):
+                return bytes(out)
+
+    async def run(self, commands, timeout=30):
+        """Same as console_run(), on this console."""
+        if isinstance(commands, str):
+            commands = commands.splitlines()
+        commands = [cmd.strip() for cmd in commands if cmd.strip()]
+        async with self.lock:
+            # Keep any output left over from earlier commands
+            out = self._take()
+            for cmd in commands:
+                self.writer.write(cmd.encode('ascii') + b'\n')
+                await self.writer.drain()
+                out += await self._read_until_prompt(cmd, timeout)
+        return _PAGING_ERASE.sub('', out.decode(errors='replace'))
+
+
+class ConsoleMultiplexer(object):
+    """Drives the consoles of many routers at once from a single asyncio event loop.
+
+    The event loop runs in one background thread, so the methods below can be
+    called from normal notebook cells. At most max_concurrency commands are in
+    flight at the same time.
+
+    Keyword arguments:
+    sim -- an instance of the Vxr object
+    routers -- the router names in the simulation (default: all of them)
+
+    Routers whose console fails to open are left out of self.consoles and
+    kept with their exception in self.failed.
+    """
+
+    def __init__(self, sim, routers=None, max_concurrency=64):
+        console_ports = sim.ports()
+        if routers is None:
+            routers = [r for r in console_ports if 'serial0' in console_ports[r]]
+        self.consoles = {r: AsyncConsole(r, console_ports[r]['HostAgent'], console_ports[r]['serial0']) for r in routers}
+        self.failed = {}
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        try:
+            self._call(self._open())
+        except BaseException:
+            self.close()
+            raise
+        if self.failed:
+            print("Consoles failed to open:", ', '.join('%s (%s)' % (r, e) for r, e in self.failed.items()))
+            if not self.consoles:
+                self.close()
+                raise next(iter(self.failed.values()))
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _open(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*(console.open() for console in self.consoles.values()), return_exceptions=True)
+        for router, result in list(zip(self.consoles, results)):
+            if isinstance(result, BaseException):
+                # The connection may be open with no prompt yet
+                await self.consoles.pop(router).close()
+                self.failed[router] = result
+
+    async def _run_one(self, router, commands, timeout):
+        if router in self.failed:
+            return self.failed[router]
+        async with self.semaphore:
+            try:
+                return await self.consoles[router].run(commands, timeout)
+            except Exception as e:
+                return e
+
+    async def _run(self, commands, routers, timeout):
+        routers = list(self.consoles) if routers is None else routers
+        if isinstance(commands, dict):
+            jobs = {r: commands[r] for r in commands}
+        else:
+            jobs = {r: commands for r in routers}
+        outputs = await asyncio.gather(*(self._run_one(r, cmds, timeout) for r, cmds in jobs.items()))
+        return dict(zip(jobs, outputs))
+
+    def run(self, commands, routers=None, timeout=30):
+        """Run commands on many consoles at the same time.
+
+        commands is either the commands to run on every router in routers
+        (default: all routers), or a dict of {router: commands}.
+        Returns {router: output}, with the exception as output if a console failed
+        (to open, for the routers in self.failed).
+        """
+        return self._call(self._run(commands, routers, timeout))
+
+    async def _close(self):
+        await asyncio.gather(*(console.close() for console in self.consoles.values()))
+
+    def close(self):
+        self._call(self._close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()